@@ -0,0 +1,220 @@
+'''
+Load test: N simulated users send /start and then messages through the real front-end handlers, which go through
+submit_step, run_state_machine_step, sm.task_queue, the dispatcher and Engine.execute_task down to a fake Telegram
+(benchmarks/fake_telegram.py). Every update of the default state machine gets one reply, so the time from calling the
+handler to the reply reaching the fake is the end-to-end latency.
+
+Reports updates/s, p50/p99 latency and the memory each user keeps, and appends the results to a JSON lines file with
+the commit they were measured on, comparing them with the last run that used the same parameters.
+
+Run it from the root of the repo:
+    python -m benchmarks.bench_load --users 1000 --updates 10
+    python -m benchmarks.bench_load --users 200 --api-latency 0.05 --error-rate 0.01 --server-chat-rate 1 --limiter
+'''
+import os
+import gc
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import itertools
+import contextlib
+import subprocess
+import tracemalloc
+import importlib.util
+from collections import deque
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FRONT_ENDS = {
+    "ptb": "python-telegram-bot_implementation.py",
+    "hydrogram": "hydrogram_implementation.py",
+}
+
+os.environ.setdefault("TELEGRAM_TOKEN", "1:fake")  # The front-ends read these when imported, nothing connects to Telegram
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "fake")
+
+import state_machine as sm
+from engine import Engine
+from rate_limit import RateLimiter
+from benchmarks.fake_telegram import FakeTransport
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def load_front_end(name):
+    '''
+    Returns (start(user_id), message(user_id, text)) that call the handlers of a front-end with fake updates.
+    '''
+    spec = importlib.util.spec_from_file_location(f"front_end_{name}", os.path.join(ROOT, FRONT_ENDS[name]))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    ids = itertools.count(1)  # Every fake update is a new one, so none is dropped as repeated
+
+    if name == "ptb":
+        def update(user_id, text=None):
+            return SimpleNamespace(update_id=next(ids), message=SimpleNamespace(text=text), effective_user=SimpleNamespace(id=user_id))
+        return (lambda user_id: module.start_command_handler(update(user_id), None),
+                lambda user_id, text: module.message_handler(update(user_id, text), None))
+
+    def message(user_id, text=None):
+        return SimpleNamespace(id=next(ids), text=text, chat=SimpleNamespace(id=user_id), from_user=SimpleNamespace(id=user_id))
+    return (lambda user_id: module.start_command_handler(module.app, message(user_id)),
+            lambda user_id, text: module.message_handler(module.app, message(user_id, text)))
+
+
+class Load:
+    '''
+    Drives the users and matches each reply with the update that caused it (per user they come back in order).
+    '''
+    def __init__(self, transport, start, message, updates, think, seed):
+        self.start = start
+        self.message = message
+        self.updates = updates
+        self.think = think
+        self.random = random.Random(seed)
+        self.sent = {}  # user_id -> deque of perf_counter() of the updates waiting for their reply
+        self.latencies = []
+        self.failed = 0
+        self.expected = 0
+        self.finished = asyncio.Event()
+        transport.on_result = self.on_result
+
+    def on_result(self, chat_id, ok):
+        sent_at = self.sent[chat_id].popleft()
+        if ok:
+            self.latencies.append(time.perf_counter() - sent_at)
+        else:
+            self.failed += 1
+        if len(self.latencies) + self.failed >= self.expected:
+            self.finished.set()
+
+    async def user(self, user_id):
+        sent = self.sent[user_id] = deque()
+        for index in range(self.updates):
+            sent.append(time.perf_counter())
+            if index == 0:
+                await self.start(user_id)
+            else:
+                await self.message(user_id, "Hola")
+            if self.think:
+                await asyncio.sleep(self.random.uniform(0, self.think))
+
+    async def run(self, user_ids, timeout):
+        self.expected += len(user_ids) * self.updates
+        self.finished.clear()
+        await asyncio.gather(*(self.user(user_id) for user_id in user_ids))
+        await asyncio.wait_for(self.finished.wait(), timeout)
+
+
+async def run(args):
+    transport = FakeTransport(args.api_latency, args.jitter, args.error_rate, args.server_global_rate, args.server_chat_rate, seed=args.seed)
+    start, message = load_front_end(args.front_end)
+    await sm.start_state_machine()
+    engine = Engine(transport, workers=args.workers, limiter=RateLimiter() if args.limiter else None)
+    if not args.limiter:
+        engine.dispatcher.limiter = None  # Engine falls back to the default limits, here we want none
+    await engine.start()
+    load = Load(transport, start, message, args.updates, args.think, args.seed)
+
+    # The handlers and the dispatcher print every failed task, that would measure the terminal
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        began = time.perf_counter()
+        await load.run(range(1, args.users + 1), args.timeout)
+        elapsed = time.perf_counter() - began
+        failed, flood_waits = load.failed, transport.flood_waits
+
+        # Memory kept per user: a second batch of new users with allocations traced, measured once they are idle
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        await load.run(range(args.users + 1, 2 * args.users + 1), args.timeout)
+        await asyncio.sleep(0)
+        gc.collect()
+        memory = (tracemalloc.get_traced_memory()[0] - before) / args.users
+        tracemalloc.stop()
+
+        await sm.drain_state_machine()
+        await engine.stop()
+        await sm.stop_state_machine()
+
+    updates = args.users * args.updates
+    latencies = load.latencies[:updates]
+    return {
+        "updates": updates,
+        "elapsed": elapsed,
+        "updates_per_second": updates / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "failed": failed,
+        "flood_waits": flood_waits,
+        "bytes_per_user": memory,
+    }
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(path, params, results):
+    '''
+    Appends the run to path and returns the last earlier run with the same parameters, or None.
+    '''
+    previous = None
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                entry = json.loads(line)
+                if entry["params"] == params:
+                    previous = entry
+    entry = {"date": datetime.datetime.now().isoformat(timespec="seconds"), "commit": commit(), "python": sys.version.split()[0], "params": params, "results": results}
+    with open(path, "a", encoding="utf-8") as file:
+        file.write(json.dumps(entry) + "\n")
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--updates", type=int, default=10, help="Updates per user, the first one is /start")
+    parser.add_argument("--think", type=float, default=0.0, help="Maximum time between two updates of a user, in seconds")
+    parser.add_argument("--front-end", choices=FRONT_ENDS, default="ptb", help="Whose handlers receive the updates")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Time the fake Telegram takes per call, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra time per call, up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls that fail")
+    parser.add_argument("--server-global-rate", type=float, default=0.0, help="Messages per second the fake allows before flood waits, 0 for no limit")
+    parser.add_argument("--server-chat-rate", type=float, default=0.0, help="Same, per chat")
+    parser.add_argument("--limiter", action="store_true", help="Use the dispatcher's rate limiter (RATE_LIMIT_* in the .env)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=300.0, help="Seconds to wait for the replies of each batch")
+    parser.add_argument("--results", default=os.path.join(ROOT, "benchmarks", "results.jsonl"), help="File the results are appended to")
+    args = parser.parse_args()
+
+    params = {key: value for key, value in vars(args).items() if key not in ("results", "timeout")}
+    results = asyncio.run(run(args))
+    previous = save(args.results, params, results)
+
+    print(f"users: {args.users}  updates: {results['updates']}  workers: {args.workers}  front-end: {args.front_end}")
+    print(f"throughput: {results['updates_per_second']:.0f} updates/s  p50: {results['p50_ms']:.2f} ms  p99: {results['p99_ms']:.2f} ms")
+    print(f"failed: {results['failed']}  flood waits: {results['flood_waits']}  memory: {results['bytes_per_user']:.0f} bytes/user")
+    if previous:
+        before = previous["results"]
+        print(f"vs {previous['commit'] or previous['date']}: "
+              f"throughput {results['updates_per_second'] / before['updates_per_second'] - 1:+.1%}  "
+              f"p99 {results['p99_ms'] / before['p99_ms'] - 1 if before['p99_ms'] else 0:+.1%}  "
+              f"memory {results['bytes_per_user'] / before['bytes_per_user'] - 1 if before['bytes_per_user'] else 0:+.1%}")
+
+
+if __name__ == "__main__":
+    main()
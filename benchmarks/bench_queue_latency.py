@@ -0,0 +1,71 @@
+'''
+Measures the time between sm.send_message and the moment the message reaches the client, using a fake client instead of Telegram.
+Messages are sent one at a time with an idle gap in between, which is where a polling consumer adds its latency.
+
+Run it from the root of the repo:
+    python -m benchmarks.bench_queue_latency --messages 200 --idle 0.05
+'''
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import state_machine as sm
+from dispatcher import Dispatcher
+
+
+class FakeClient:
+    '''
+    Stands in for app / application.bot. It records when each message arrives.
+    '''
+    def __init__(self, api_latency=0.0):
+        self.api_latency = api_latency
+        self.received = {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        self.received[text] = time.perf_counter()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run(messages, idle, workers, api_latency):
+    client = FakeClient(api_latency)
+
+    async def execute_task(task):
+        await client.send_message(chat_id=task.user_id, text=task.text)
+
+    dispatcher = Dispatcher(execute_task, workers=workers)
+    dispatcher.start()
+
+    sent_at = {}
+    for i in range(messages):
+        text = str(i)
+        sent_at[text] = time.perf_counter()
+        await sm.send_message(random.randint(1, 1000), text)
+        await asyncio.sleep(random.uniform(0, idle))
+
+    await dispatcher.stop()
+
+    latencies = [(client.received[text] - sent_at[text]) * 1000 for text in sent_at]
+    print(f"messages: {messages}  workers: {workers}  api latency: {api_latency * 1000:.1f} ms")
+    print(f"enqueue -> send  mean: {statistics.mean(latencies):.3f} ms  p50: {percentile(latencies, 50):.3f} ms  p99: {percentile(latencies, 99):.3f} ms  max: {max(latencies):.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--idle", type=float, default=0.05, help="Maximum idle time between two messages, in seconds")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Time the fake client takes per call, in seconds")
+    args = parser.parse_args()
+    asyncio.run(run(args.messages, args.idle, args.workers, args.api_latency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+'''
+Compares the old (user_id, action, params dict) tasks with the slotted task objects: building the task, finding what
+executes it and reading its fields, plus the memory each one takes.
+
+Run it from the root of the repo:
+    python -m benchmarks.bench_task_objects --number 200000
+'''
+import argparse
+import timeit
+import tracemalloc
+
+import tasks
+
+ACTIONS = ["message", "editmessage", "delete", "photo", "document", "video", "poll"]
+
+
+# --- OLD PATH ---
+
+def build_dict(user_id, text):
+    return (user_id, "poll", {
+        "question": text,
+        "options": ["a", "b"],
+        "type": "regular",
+        "correct_option_id": None,
+        "is_anonymous": False,
+        "open_period": None,
+        "allow_multiple_answers": None,
+        "explanation": None,
+        "explanation_parse_mode": None,
+        "reply_to_message_id": None,
+        "allow_sending_without_reply": None,
+        "keyboard": None,
+        "inline_keyboard": None,
+        "save": None
+    })
+
+def execute_dict(task):
+    user_id, action, params = task
+    # Same chain as the old execute_task, poll is the last branch
+    for name in ACTIONS:
+        if action == name:
+            break
+    return (user_id, params.get("question", None), params.get("options", None), params.get("type", None),
+            params.get("correct_option_id", None), params.get("is_anonymous", None), params.get("open_period", None),
+            params.get("allow_multiple_answers", None), params.get("explanation", None), params.get("explanation_parse_mode", None),
+            params.get("reply_to_message_id", None), params.get("allow_sending_without_reply", None), params.get("keyboard", None),
+            params.get("inline_keyboard", None), params.get("remove_keyboard", False), params.get("save", None))
+
+
+# --- NEW PATH ---
+
+def build_object(user_id, text):
+    return tasks.PollTask(user_id=user_id, question=text, options=["a", "b"])
+
+def read_poll(task):
+    return (task.user_id, task.question, task.options, task.type, task.correct_option_id, task.is_anonymous, task.open_period,
+            task.allow_multiple_answers, task.explanation, task.explanation_parse_mode, task.reply_to_message_id,
+            task.allow_sending_without_reply, task.keyboard, task.inline_keyboard, task.remove_keyboard, task.save)
+
+handlers = {tasks.PollTask: read_poll}
+
+def execute_object(task):
+    return handlers[type(task)](task)
+
+
+def memory_per_task(build, count=10000):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [build(i, "question") for i in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "lineno"))
+    del kept
+    return size / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=200000)
+    args = parser.parse_args()
+
+    for name, build, execute in [("dict", build_dict, execute_dict), ("slots", build_object, execute_object)]:
+        build_time = min(timeit.repeat(lambda: build(1, "question"), number=args.number, repeat=3)) / args.number
+        task = build(1, "question")
+        execute_time = min(timeit.repeat(lambda: execute(task), number=args.number, repeat=3)) / args.number
+        print(f"{name:>5}  build: {build_time * 1e9:7.1f} ns  dispatch+read: {execute_time * 1e9:7.1f} ns  memory: {memory_per_task(build):7.1f} B/task")
+
+
+if __name__ == "__main__":
+    main()
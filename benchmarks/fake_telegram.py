@@ -0,0 +1,125 @@
+'''
+In-process stand-in for Telegram, implementing the Transport protocol (transport.py) so the real Engine can run on it.
+Calls take a configurable latency, fail at a configurable rate and answer with flood waits past configurable rate limits,
+all from a seeded random generator so runs can be compared.
+'''
+import math
+import random
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+import retry
+from rate_limit import TokenBucket
+
+
+class FakeAPIError(Exception):
+    pass
+
+
+class FakeFloodWait(FakeAPIError):
+    def __init__(self, seconds):
+        super().__init__(f"Flood wait of {seconds}s")
+        self.seconds = seconds
+
+
+class FakeTransport:
+    '''
+    latency and jitter are in seconds (each call takes latency plus up to jitter), error_rate is the fraction of calls that
+    fail and global_rate / chat_rate are messages per second allowed before answering with a flood wait (0 = no limit).
+    on_result(chat_id, ok) is called after every call that reached the fake server, except flood waits.
+    '''
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, global_rate=0.0, chat_rate=0.0, chat_burst=3, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.global_bucket = TokenBucket(global_rate, global_rate) if global_rate else None
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chats = {}  # chat_id -> TokenBucket
+        self.random = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.on_result = None
+        self.calls = 0
+        self.flood_waits = 0
+
+    async def call(self, chat_id, **media):
+        self.calls += 1
+        now = asyncio.get_running_loop().time()
+        buckets = [self.global_bucket] if self.global_bucket else []
+        if self.chat_rate:
+            bucket = self.chats.get(chat_id)
+            if bucket is None:
+                bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            buckets.append(bucket)
+        wait = max((bucket.delay(now) for bucket in buckets), default=0)
+        if wait > 0:
+            self.flood_waits += 1
+            raise FakeFloodWait(math.ceil(wait))
+        for bucket in buckets:
+            bucket.take(now)
+
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        failed = self.random.random() < self.error_rate
+        if self.on_result:
+            self.on_result(chat_id, not failed)
+        if failed:
+            raise FakeAPIError("Bad Request: fake error")
+        message_id = next(self.ids)
+        files = {kind: SimpleNamespace(file_id=f"{kind}-{message_id}") for kind in media}
+        return SimpleNamespace(message_id=message_id, **files)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self.call(chat_id)
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        return await self.call(chat_id)
+
+    async def delete_message(self, chat_id, message_id):
+        return await self.call(chat_id)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        return await self.call(chat_id, photo=photo)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        return await self.call(chat_id, document=document)
+
+    async def send_video(self, chat_id, video, **kwargs):
+        return await self.call(chat_id, video=video)
+
+    async def send_poll(self, chat_id, question, options, **kwargs):
+        return await self.call(chat_id)
+
+    async def stream_file(self, file_id):
+        for _ in range(4):
+            yield bytes(1024)
+
+    def message_id(self, message):
+        return message.message_id
+
+    def file_id(self, message, kind):
+        media = getattr(message, kind, None)
+        return media.file_id if media else None
+
+    def keyboard(self, rows):
+        return rows
+
+    def inline_keyboard(self, rows):
+        return rows
+
+    def remove_keyboard(self):
+        return None
+
+    def retry_after(self, error):
+        return error.seconds if isinstance(error, FakeFloodWait) else None
+
+    def is_api_error(self, error):
+        return isinstance(error, FakeAPIError)
+
+    def is_invalid_file(self, error):
+        return False
+
+    def classify(self, error):
+        return retry.PERMANENT  # The fake errors are Bad Requests
@@ -0,0 +1,19 @@
+'''
+Starts the bot with the library chosen in the .env file: BOT_BACKEND=ptb (python-telegram-bot, the default) or BOT_BACKEND=hydrogram.
+Both front-ends share the same engine, so switching only changes how Telegram is talked to.
+'''
+import os
+import runpy
+from dotenv import load_dotenv
+
+FRONT_ENDS = {
+    "ptb": "python-telegram-bot_implementation.py",
+    "hydrogram": "hydrogram_implementation.py",
+}
+
+if __name__ == "__main__":
+    load_dotenv()
+    backend = os.getenv("BOT_BACKEND", "ptb")
+    if backend not in FRONT_ENDS:
+        raise SystemExit(f"Unknown BOT_BACKEND: {backend}. Use one of: {', '.join(FRONT_ENDS)}")
+    runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), FRONT_ENDS[backend]), run_name="__main__")
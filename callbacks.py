@@ -0,0 +1,208 @@
+'''
+Structured callback data. A button of an inline_keyboard can carry a dict instead of a string:
+
+    await sm.send_message(user_id, "Pick one", inline_keyboard=[[("Red", {"route": "color", "value": "red"})]])
+
+It is packed as "color|{"value":"red"}" and, if that doesn't fit in the 64 bytes Telegram allows, kept here and
+replaced by a short key. The front-ends decode it again, so the state machine gets data["callback_data"] = "color" and
+data["callback_args"] = {"value": "red"}. Plain string callback data keeps working as before, with empty callback_args.
+CallbackRouter finds the handler of a route by its longest registered prefix.
+'''
+import os
+import re
+import json
+import time
+import base64
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+from storage import WriteBehind, FLUSH_INTERVAL
+
+CALLBACK_STORE_SIZE = int(os.getenv("CALLBACK_STORE_SIZE", "100000"))  # Payloads too long for a button kept in memory
+CALLBACK_TTL = float(os.getenv("CALLBACK_TTL", str(7 * 24 * 3600)))  # Seconds they are kept in the backend
+
+MAX_CALLBACK_DATA = 64  # Bytes, Telegram's limit
+STORED = "~"  # Keys of stored payloads are it and 16 URL-safe base64 characters
+STORED_KEY = re.compile(re.escape(STORED) + r"[A-Za-z0-9_-]{16}")  # Other data that starts with it is plain data
+SEPARATOR = "|"
+NAMESPACE = "callbacks"
+
+
+def pack(payload):
+    args = {key: value for key, value in payload.items() if key != "route"}
+    route = str(payload["route"])
+    if not args:
+        return route
+    return route + SEPARATOR + json.dumps(args, separators=(",", ":"), ensure_ascii=False)
+
+
+def unpack(data):
+    '''
+    Returns (route, args) of packed callback data. Data that was not packed is a route without args.
+    '''
+    route, separator, packed = data.partition(SEPARATOR)
+    if separator:
+        try:
+            args = json.loads(packed)
+        except ValueError:
+            args = None
+        if isinstance(args, dict):
+            return route, args
+    return data, {}
+
+
+class PrefixTrie:
+    '''
+    Longest prefix lookup, one character per level.
+    '''
+    def __init__(self, prefixes=None):
+        self.root = {}
+        for prefix, target in (prefixes or {}).items():
+            self.add(prefix, target)
+
+    def add(self, prefix, target):
+        node = self.root
+        for character in prefix:
+            node = node.setdefault(character, {})
+        node[None] = target  # None can't be a character, it marks the end of a prefix
+
+    def longest(self, text):
+        node = self.root
+        found = node.get(None)
+        for character in text:
+            node = node.get(character)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+
+class CallbackStore:
+    '''
+    Encodes the callback data of buttons and decodes it when they are pressed. Payloads that don't fit are kept by key,
+    the least recently used ones are dropped from memory past max_entries. If a storage backend is given, they are also
+    written to it in batches (expiring after ttl) and looked up there on a miss, so buttons keep working after a restart.
+    Payloads that keep being sent or pressed (touch, decode) stay: they move to the end of the LRU and, past half their
+    ttl, are written again with a new expiry.
+    '''
+    def __init__(self, backend=None, max_entries=CALLBACK_STORE_SIZE, ttl=CALLBACK_TTL, flush_interval=FLUSH_INTERVAL):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> [packed payload, time after which using it writes it again with a new expiry]
+        self.writer = WriteBehind(backend, NAMESPACE, flush_interval)  # key -> packed payload
+
+    def encode(self, payload):
+        '''
+        Returns the callback data for a button: a string as it is, a dict with a "route" packed. Too long ones are stored.
+        '''
+        data = payload if isinstance(payload, str) else pack(payload)
+        if len(data.encode()) <= MAX_CALLBACK_DATA and not STORED_KEY.fullmatch(data):  # Data shaped like a key is stored too
+            return data
+        # The same payload always gets the same key, so rebuilding a menu doesn't store it again
+        key = STORED + base64.urlsafe_b64encode(hashlib.blake2b(data.encode(), digest_size=12).digest()).decode()
+        if key in self.entries:
+            self.use(key)
+        else:
+            self.remember(key, data)
+        return key
+
+    def is_key(self, data):
+        return isinstance(data, str) and STORED_KEY.fullmatch(data) is not None
+
+    def remember(self, key, data, refresh=None):
+        self.entries[key] = [data, refresh]
+        if refresh is None:
+            self.save(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self, key):
+        entry = self.entries[key]
+        now = time.time()
+        self.writer.put(key, entry[0], now + self.ttl)
+        entry[1] = now + self.ttl / 2
+
+    def use(self, key):
+        self.entries.move_to_end(key)
+        if self.backend and self.entries[key][1] <= time.time():
+            self.save(key)
+
+    def touch(self, keys):
+        '''
+        Marks the stored payloads of a markup that is sent again (markup.MarkupBuilder calls it on a cache hit). Returns
+        False if one of them is not in memory anymore, then the markup has to be built again so they are stored again.
+        '''
+        if not all(key in self.entries for key in keys):
+            return False
+        for key in keys:
+            self.use(key)
+        return True
+
+    async def decode(self, data):
+        '''
+        Returns (route, args) for the callback data of a pressed button. If it was stored and is not anymore, route is None.
+        '''
+        if data is None or not STORED_KEY.fullmatch(data):
+            return unpack(data) if data is not None else (None, {})
+        if data in self.entries:
+            self.use(data)
+            return unpack(self.entries[data][0])
+        packed = None
+        if self.backend:
+            packed = self.writer.get(data) or await asyncio.to_thread(self.backend.load_value, NAMESPACE, data)
+        if packed is None:
+            print(f"Callback data {data} expired")
+            return None, {}
+        self.remember(data, packed, refresh=0)  # Its expiry is not known, the next use writes it again
+        return unpack(packed)
+
+    async def flush(self):
+        await self.writer.flush()
+
+    def start(self):
+        if self.backend:
+            self.writer.start()
+
+    async def stop(self):
+        await self.writer.stop()
+
+
+class CallbackRouter:
+    '''
+    Maps routes to handlers by prefix, so one handler can serve "item" for "item", "item_buy", "item_sell"...
+    Handlers get the step data (with callback_data and callback_args) and return the next state:
+
+        router = CallbackRouter()
+
+        @router.on("item")
+        async def item(data):
+            await sm.send_message(data["id"], f"Item {data['callback_args']['id']}")
+            return "ITEM"
+
+        # In a transition: next_state = await router.dispatch(data) or "MAIN"
+        # Or as the transition of a state, with a catch-all @router.on("") so it always returns a state
+    '''
+    def __init__(self):
+        self.handlers = PrefixTrie()
+
+    def on(self, prefix):
+        def register(handler):
+            self.handlers.add(prefix, handler)
+            return handler
+        return register
+
+    async def dispatch(self, data):
+        '''
+        Runs the handler of the callback in data and returns what it returned, or None if there is no callback or no handler.
+        '''
+        route = data.get("callback_data")
+        if route is None:
+            return None
+        handler = self.handlers.longest(route)
+        if handler is None:
+            return None
+        return await handler(data)
+
+    transition = dispatch
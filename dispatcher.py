@@ -0,0 +1,332 @@
+import os
+import time
+import asyncio
+from collections import deque, OrderedDict
+
+import state_machine as sm
+import metrics
+import retry
+from tasks import RunTask, EditMessageTask, PRIORITIES, INTERACTIVE, NORMAL, RUN, BULK
+
+DISPATCHER_WORKERS = int(os.getenv("DISPATCHER_WORKERS", "8"))
+EDIT_MIN_INTERVAL = float(os.getenv("EDIT_MIN_INTERVAL_MS", "1000")) / 1000  # Between two edits of the same message
+# Share of the turns each lane gets while the others have users waiting too, an idle lane leaves its share to the rest
+LANE_WEIGHTS = {
+    INTERACTIVE: float(os.getenv("LANE_WEIGHT_INTERACTIVE", "8")),
+    NORMAL: float(os.getenv("LANE_WEIGHT_NORMAL", "4")),
+    RUN: float(os.getenv("LANE_WEIGHT_RUN", "2")),
+    BULK: float(os.getenv("LANE_WEIGHT_BULK", "1")),
+}
+RANK = {priority: rank for rank, priority in enumerate(PRIORITIES)}
+
+
+class Line(deque):
+    '''
+    Tasks waiting for one user, in order, counting how many there are of each priority.
+    '''
+    def __init__(self, tasks=()):
+        super().__init__()
+        self.counts = [0] * len(PRIORITIES)
+        self.extend(tasks)
+
+    def append(self, task):
+        super().append(task)
+        self.counts[RANK[task.priority]] += 1
+
+    def extend(self, tasks):
+        for task in tasks:
+            self.append(task)
+
+    def appendleft(self, task):
+        super().appendleft(task)
+        self.counts[RANK[task.priority]] += 1
+
+    def popleft(self):
+        task = super().popleft()
+        self.counts[RANK[task.priority]] -= 1
+        return task
+
+    def remove(self, task):
+        super().remove(task)
+        self.counts[RANK[task.priority]] -= 1
+
+    def __setitem__(self, index, task):
+        self.counts[RANK[self[index].priority]] -= 1
+        super().__setitem__(index, task)
+        self.counts[RANK[task.priority]] += 1
+
+    def lane(self):
+        '''
+        The highest priority among the tasks, the user waits in that lane. The tasks still go out in order.
+        '''
+        for rank, count in enumerate(self.counts):
+            if count:
+                return PRIORITIES[rank]
+        return PRIORITIES[-1]
+
+
+class Lanes:
+    '''
+    Users ready to be served, in one FIFO per priority. get() picks the lane with smooth weighted round robin, so every
+    lane with users waiting gets its share of the turns (and of the rate limit) and a busy lane can't starve the rest.
+    '''
+    def __init__(self, weights=None):
+        self.weights = weights or LANE_WEIGHTS
+        self.queues = {priority: deque() for priority in PRIORITIES}
+        self.waiting = dict.fromkeys(PRIORITIES, 0)  # Users waiting in each lane, the queues can also hold stale entries
+        self.current = dict.fromkeys(PRIORITIES, 0.0)
+        self.queued = {}  # user_id -> lane it is waiting in
+        self.getters = deque()  # Futures of the workers waiting for a user
+
+    def qsize(self):
+        return len(self.queued)
+
+    def put_nowait(self, user_id, lane):
+        if self.promote(user_id, lane) is not None:
+            return
+        self.queued[user_id] = lane
+        self.queues[lane].append(user_id)
+        self.waiting[lane] += 1
+        self.wake()
+
+    def wake(self):
+        while self.getters:
+            getter = self.getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                return
+
+    def promote(self, user_id, lane):
+        '''
+        Moves a waiting user to a higher lane. Returns the lane the user is waiting in, or None if it is not waiting.
+        '''
+        current = self.queued.get(user_id)
+        if current is not None and RANK[lane] < RANK[current]:
+            self.queued[user_id] = lane
+            self.queues[lane].append(user_id)  # The entry in the old lane is skipped when it comes up
+            self.left(current)
+            self.waiting[lane] += 1
+            return lane
+        return current
+
+    def pick(self):
+        active = [lane for lane in PRIORITIES if self.waiting[lane]]
+        if len(active) == 1:  # Nothing to share
+            return active[0]
+        total = 0.0
+        for lane in active:
+            self.current[lane] += self.weights[lane]
+            total += self.weights[lane]
+        chosen = max(active, key=self.current.__getitem__)
+        self.current[chosen] -= total
+        return chosen
+
+    def left(self, lane):
+        self.waiting[lane] -= 1
+        if not self.waiting[lane]:
+            self.current[lane] = 0.0  # An idle lane doesn't save up turns
+
+    async def get(self):
+        while not self.queued:
+            getter = asyncio.get_running_loop().create_future()
+            self.getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                if getter.done() and self.queued:
+                    self.wake()  # It was woken for a user, pass the turn on
+                raise
+        lane = self.pick()
+        queue = self.queues[lane]
+        while True:
+            user_id = queue.popleft()
+            if self.queued.get(user_id) == lane:
+                del self.queued[user_id]
+                self.left(lane)
+                return user_id
+
+
+class Dispatcher:
+    '''
+    Drains sm.task_queue with a pool of workers. Tasks of the same user are executed in order, tasks of different users are executed in parallel.
+    Users take turns by the priority of their tasks (see Lanes), a user with an interactive reply waiting goes in the interactive lane.
+    '''
+    def __init__(self, execute, workers=DISPATCHER_WORKERS, limiter=None, retry_after=None, edit_interval=EDIT_MIN_INTERVAL, classify=None, policy=None, weights=None):
+        self.execute = execute
+        self.workers = workers
+        self.limiter = limiter  # rate_limit.RateLimiter, or None to send as fast as the queue drains
+        self.retry_after = retry_after  # Returns the seconds Telegram asked us to wait if the exception is a flood wait, else None
+        self.classify = classify  # Returns retry.RETRY, retry.BLOCKED or retry.PERMANENT for an exception, without it nothing is retried
+        self.policy = policy or retry.RetryPolicy()
+        self.pending = {}  # user_id -> Line of tasks waiting for that user
+        self.ready = Lanes(weights)  # users that have pending tasks and no worker on them
+        self.tasks = []
+        self.edit_interval = edit_interval
+        self.edited = OrderedDict()  # (user_id, message name) -> when it was last edited, oldest first
+        self.queue_wait = {priority: metrics.histogram("task_queue_wait_seconds", "Time between a task being enqueued and its execution starting", priority=priority) for priority in PRIORITIES}
+        metrics.gauge("task_queue_depth", lambda: sm.task_queue.qsize() + sum(map(len, self.pending.values())), "Tasks waiting to be executed")
+        metrics.gauge("task_queue_users", lambda: len(self.pending), "Users with tasks waiting or running")
+        for priority in PRIORITIES:
+            metrics.gauge("task_lane_users", lambda priority=priority: self.ready.waiting[priority], "Users waiting for a worker in each lane", priority=priority)
+
+    def route(self, task):
+        if task.user_id in sm.blocked_users and not isinstance(task, RunTask):
+            self.skip(task)
+            return
+        pending = self.pending.get(task.user_id)
+        if pending is None:
+            self.pending[task.user_id] = Line([task])
+            self.ready.put_nowait(task.user_id, task.priority)
+        elif not (isinstance(task, EditMessageTask) and self.coalesce(pending, task)):
+            # A worker already owns this user (or it is waiting in ready), it will pick this up in order
+            pending.append(task)
+            self.ready.promote(task.user_id, task.priority)
+
+    def skip(self, task):
+        # The user blocked the bot, the API call would only fail
+        if task.done and not task.done.done():
+            task.done.set_exception(retry.UserBlocked(f"User {task.user_id} blocked the bot"))
+        sm.task_queue.ack(task)
+        metrics.inc("tasks_skipped_blocked_total")
+
+    def coalesce(self, pending, task):
+        '''
+        If an edit of the same message is still waiting, task takes its place so only the latest content is sent.
+        Returns False if there is none, or if a task in between saves another message under that name.
+        '''
+        for index in range(len(pending) - 1, -1, -1):
+            waiting = pending[index]
+            if isinstance(waiting, EditMessageTask) and waiting.message_id == task.message_id and waiting.priority == task.priority:
+                pending[index] = task
+                if waiting.done and not waiting.done.done():
+                    waiting.done.set_result(None)  # Superseded, its content is never sent
+                sm.task_queue.ack(waiting)
+                metrics.inc("edits_coalesced_total")
+                return True
+            if getattr(waiting, "save", None) == task.message_id:
+                return False
+        return False
+
+    def edit_delay(self, task):
+        # Seconds until this message may be edited again
+        edited = self.edited.get((task.user_id, task.message_id))
+        if edited is None:
+            return 0.0
+        return edited + self.edit_interval - time.perf_counter()
+
+    def record_edit(self, task):
+        now = time.perf_counter()
+        key = (task.user_id, task.message_id)
+        self.edited[key] = now
+        self.edited.move_to_end(key)
+        while self.edited and next(iter(self.edited.values())) <= now - self.edit_interval:  # They can be edited right away
+            self.edited.popitem(last=False)
+
+    async def router(self):
+        while True:
+            task = await sm.task_queue.get()  # Sleeps until something is enqueued, no polling
+            self.route(task)
+
+    def defer(self, user_id, delay):
+        '''
+        Gives the user back to the workers after delay seconds, without keeping a worker busy in the meantime.
+        '''
+        asyncio.get_running_loop().call_later(delay, self.requeue, user_id)
+
+    def requeue(self, user_id):
+        pending = self.pending.get(user_id)
+        if pending:
+            self.ready.put_nowait(user_id, pending.lane())
+
+    async def worker(self):
+        while True:
+            user_id = await self.ready.get()
+            pending = self.pending[user_id]
+            task = pending[0]
+
+            if self.edit_interval and isinstance(task, EditMessageTask):
+                # Waiting here lets the next edits of this message replace this one
+                delay = self.edit_delay(task)
+                if delay > 0:
+                    self.defer(user_id, delay)
+                    continue
+
+            if self.limiter and not isinstance(task, RunTask):  # Running a step doesn't call the Telegram API
+                delay = self.limiter.chat_delay(user_id)
+                if delay > 0:
+                    self.defer(user_id, delay)
+                    continue
+                await self.limiter.acquire(user_id)
+
+            task = pending.popleft()  # Not the one peeked if a newer edit replaced it in the meantime
+            if self.edit_interval and isinstance(task, EditMessageTask):
+                self.record_edit(task)
+            self.queue_wait[task.priority].observe(time.perf_counter() - task.enqueued_at)
+            try:
+                await self.execute(task)
+            except Exception as e:
+                seconds = self.retry_after(e) if self.retry_after else None
+                if seconds is not None:
+                    # Flood wait: only this chat is parked, the task goes back to the front of its line
+                    print(f"Flood wait of {seconds}s for user {user_id}")
+                    if self.limiter:
+                        self.limiter.park(user_id, seconds)
+                    pending.appendleft(task)
+                    self.defer(user_id, seconds)
+                    continue
+
+                kind = self.classify(e) if self.classify else retry.PERMANENT
+                if kind == retry.RETRY and task.attempts < self.policy.max_attempts:
+                    # Transient: back to the front of its line after a backoff, the other users go on meanwhile
+                    task.attempts += 1
+                    delay = self.policy.delay(task.attempts)
+                    print(f"Retrying task for user {user_id} in {delay:.2f}s (attempt {task.attempts}): {e}")
+                    metrics.inc("task_retries_total")
+                    pending.appendleft(task)
+                    self.defer(user_id, delay)
+                    continue
+
+                print(f"Error in task_handler: {e}\n\nTask: {task}")
+                if kind == retry.BLOCKED:
+                    try:
+                        await sm.blocked_users.add(user_id)  # Marked in memory even if saving it fails
+                    except Exception as error:
+                        print(f"Error saving blocked user: {error}")
+                    for waiting in [waiting for waiting in pending if not isinstance(waiting, RunTask)]:
+                        pending.remove(waiting)
+                        self.skip(waiting)
+                try:
+                    await sm.dead_letters.add(task, e, kind)
+                except Exception as error:
+                    print(f"Error saving dead letter: {error}")
+                if task.done and not task.done.done():
+                    task.done.set_exception(e)
+            else:
+                if task.done and not task.done.done():
+                    task.done.set_result(None)
+            sm.task_queue.ack(task)  # A durable queue forgets it, it won't be sent again after a restart
+
+            if pending:
+                self.ready.put_nowait(user_id, pending.lane())  # Back of the line, so one busy user can't starve the rest
+            else:
+                del self.pending[user_id]
+
+    def start(self):
+        self.tasks.append(asyncio.create_task(self.router()))
+        for _ in range(self.workers):
+            self.tasks.append(asyncio.create_task(self.worker()))
+
+    async def stop(self, timeout=5.0):
+        '''
+        Waits up to timeout seconds for the tasks already enqueued to be sent and then cancels the router and the workers.
+        '''
+        if timeout:
+            try:
+                await asyncio.wait_for(sm.task_queue.join(), timeout)
+            except asyncio.TimeoutError:
+                print(f"Dispatcher stopped with {sm.task_queue.qsize() + sum(map(len, self.pending.values()))} tasks pending")
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
@@ -0,0 +1,138 @@
+'''
+Downloads the media users send, in chunks so a file is never held whole in memory. Files are kept on disk by their
+file_unique_id (the same file has the same one for every bot and user), the least recently used ones are deleted once
+the cache is over its size. Protocols reach it as sm.downloads (only in the front process when SHARDS is set):
+
+    path = await sm.downloads.download(data["photo_file_id"], data["file_unique_id"])
+    async for chunk in sm.downloads.stream(data["document_file_id"], data["file_unique_id"]): ...
+'''
+import os
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+DOWNLOADS_DIR = os.getenv("DOWNLOADS_DIR", "downloads")
+DOWNLOADS_MAX_SIZE = int(float(os.getenv("DOWNLOADS_MAX_MB", "20")) * 1024 * 1024)  # Bigger files are refused, the Bot API doesn't serve more than 20 MB
+DOWNLOADS_CACHE_SIZE = int(float(os.getenv("DOWNLOADS_CACHE_MB", "1024")) * 1024 * 1024)  # Disk used by the cache
+DOWNLOADS_CONCURRENCY = int(os.getenv("DOWNLOADS_CONCURRENCY", "4"))  # Downloads running at the same time
+
+PARTIAL = ".part"
+
+
+class DownloadService:
+    def __init__(self, transport, directory=DOWNLOADS_DIR, max_size=DOWNLOADS_MAX_SIZE, cache_size=DOWNLOADS_CACHE_SIZE, concurrency=DOWNLOADS_CONCURRENCY):
+        self.transport = transport
+        self.directory = directory
+        self.max_size = max_size
+        self.cache_size = cache_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.files = OrderedDict()  # name -> size, least recently used first
+        self.used = 0
+        self.running = {}  # name -> task of the download that is running for it
+        self.scan()
+
+    def scan(self):
+        # Picks up the files of previous runs, oldest first, and deletes the downloads that were cut
+        if not os.path.isdir(self.directory):
+            return  # Created with the first download
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(PARTIAL):
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            found.append((stat.st_mtime, entry.name, stat.st_size))
+        for mtime, name, size in sorted(found):
+            self.files[name] = size
+            self.used += size
+
+    def name(self, file_id, file_unique_id):
+        # file_ids are different for each bot and can be long, the unique id is stable and safe as a file name
+        return file_unique_id or hashlib.blake2b(file_id.encode(), digest_size=16).hexdigest()
+
+    def cached(self, name):
+        if name not in self.files:
+            return None
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):  # Deleted by someone else
+            self.used -= self.files.pop(name)
+            return None
+        self.files.move_to_end(name)
+        os.utime(path)  # So the order survives a restart
+        return path
+
+    async def download(self, file_id, file_unique_id=None, max_size=None):
+        '''
+        Downloads the file to the cache directory and returns its path. If it is already there it is not downloaded again,
+        and if it is being downloaded this waits for that download. Raises ValueError if it is bigger than max_size bytes.
+        '''
+        name = self.name(file_id, file_unique_id)
+        path = self.cached(name)
+        if path:
+            return path
+
+        running = self.running.get(name)
+        if running is None:
+            running = self.running[name] = asyncio.create_task(self.fetch(file_id, name, max_size))
+            running.add_done_callback(lambda task: self.running.pop(name, None))
+        return await asyncio.shield(running)  # A cancelled waiter doesn't cancel the download for the others
+
+    async def stream(self, file_id, file_unique_id=None, max_size=None, chunk_size=1024 * 1024):
+        '''
+        Yields the file in chunks without saving it, or from the cache if it was downloaded before.
+        Raises ValueError once more than max_size bytes came.
+        '''
+        path = self.cached(self.name(file_id, file_unique_id))
+        if path:
+            with open(path, "rb") as file:
+                while chunk := await asyncio.to_thread(file.read, chunk_size):
+                    yield chunk
+            return
+
+        async with self.semaphore:
+            async for chunk in self.chunks(file_id, max_size):
+                yield chunk
+
+    async def chunks(self, file_id, max_size):
+        limit = self.max_size if max_size is None else max_size
+        received = 0
+        async for chunk in self.transport.stream_file(file_id):
+            received += len(chunk)
+            if received > limit:
+                raise ValueError(f"File {file_id} is bigger than {limit} bytes")
+            yield chunk
+
+    async def fetch(self, file_id, name, max_size):
+        path = os.path.join(self.directory, name)
+        partial = path + PARTIAL
+        size = 0
+        async with self.semaphore:
+            os.makedirs(self.directory, exist_ok=True)
+            try:
+                with open(partial, "wb") as file:
+                    async for chunk in self.chunks(file_id, max_size):
+                        await asyncio.to_thread(file.write, chunk)
+                        size += len(chunk)
+                os.replace(partial, path)
+            except BaseException:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+
+        self.files[name] = size
+        self.used += size
+        self.evict(keep=name)
+        return path
+
+    def evict(self, keep=None):
+        while self.used > self.cache_size and len(self.files) > 1:
+            name = next(iter(self.files))
+            if name == keep:  # Only the new file is left over the limit
+                break
+            self.used -= self.files.pop(name)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,310 @@
+'''
+The queue of outgoing tasks (sm.task_queue). By default it is an asyncio.Queue and whatever is in it is lost when the
+process stops. With TASK_QUEUE=sqlite in the .env the tasks are also written to TASK_QUEUE_PATH:
+
+- writes are batched, every TASK_QUEUE_FLUSH_MS all the new tasks and the finished ones go in one transaction (one
+  fsync), tasks that were executed before that never touch the disk
+- a task is removed once the dispatcher is done with it (ack), sent or failed for good
+- on startup the tasks left by the previous run are put back in the queue, in order
+- at most TASK_QUEUE_WINDOW tasks are kept in memory between the queue and the dispatcher, past that they wait on disk
+  and are read back as the dispatcher catches up, so a huge backlog doesn't grow the process
+
+A crash loses the tasks enqueued in the last TASK_QUEUE_FLUSH_MS. Tasks whose fields are not JSON (like photos given as
+bytes) and tasks someone waits on (with a done future) are also kept in memory past the window, so they keep their place
+and their future, but the non-JSON ones and the futures of replayed tasks are gone with the process that made them.
+'''
+import os
+import json
+import math
+import time
+import sqlite3
+import asyncio
+import threading
+from collections import deque
+
+import tasks
+
+TASK_QUEUE = os.getenv("TASK_QUEUE", "memory")  # "memory" or "sqlite"
+TASK_QUEUE_PATH = os.getenv("TASK_QUEUE_PATH", "tasks.db")
+TASK_QUEUE_WINDOW = int(os.getenv("TASK_QUEUE_WINDOW", "10000"))  # Tasks in memory, waiting or being executed
+TASK_QUEUE_FLUSH = float(os.getenv("TASK_QUEUE_FLUSH_MS", "50")) / 1000
+
+
+class MemoryQueue(asyncio.Queue):
+    '''
+    The default, an asyncio.Queue with the few methods the dispatcher and the engine use on a durable one.
+    '''
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def ack(self, task):
+        self.task_done()
+
+
+class SQLiteQueue:
+    '''
+    Same interface as MemoryQueue (put, get, get_nowait, qsize, empty, task_done, join), with the tasks kept in a SQLite file.
+    Ids are taken from the clock when a task is put, so they keep growing across restarts and give the order on disk.
+    '''
+    def __init__(self, path=TASK_QUEUE_PATH, window=TASK_QUEUE_WINDOW, flush_interval=TASK_QUEUE_FLUSH):
+        self.path = path
+        self.window = window
+        self.flush_interval = flush_interval
+        self.connection = None
+        self.lock = threading.Lock()  # Reads for a refill and flushes can run at the same time in their threads
+        self.items = deque()  # Tasks in memory waiting for get()
+        self.spilled = 0  # Tasks waiting only on disk (or in unwritten), after every task in items
+        self.loaded = 0  # Highest id read back into memory, the spilled tasks have higher ones
+        self.outstanding = 0  # Tasks taken with get() and not acknowledged yet
+        self.unwritten = {}  # id -> JSON of the tasks put since the last flush
+        self.writing = {}  # Same, for the flush being written right now
+        self.unstored = set()  # Ids of the tasks that are not JSON, only in memory
+        self.held = {}  # id -> spilled task kept in memory, because it is not JSON or has a done future
+        self.acked = []  # Ids to delete in the next flush
+        self.last_id = 0
+        self.unfinished = 0
+        self.finished = asyncio.Event()
+        self.finished.set()
+        self.readable = asyncio.Event()
+        self.refilling = False
+        self.flusher = None
+
+    def next_id(self):
+        self.last_id = max(time.time_ns(), self.last_id + 1)
+        return self.last_id
+
+    def qsize(self):
+        return len(self.items) + self.spilled
+
+    def empty(self):
+        return not self.qsize()
+
+    def put_nowait(self, task):
+        try:
+            data = json.dumps(tasks.dump(task))
+        except (TypeError, ValueError):
+            data = None  # Only in memory
+        self.unfinished += 1
+        self.finished.clear()
+        task.queue_id = self.next_id()
+        if data is None:
+            self.unstored.add(task.queue_id)
+        else:
+            self.unwritten[task.queue_id] = data
+        if self.spilled or len(self.items) + self.outstanding >= self.window:
+            # Once written only the row is left, it is read back when there is room. The task itself is kept when the row
+            # can't replace it, and goes back in the queue in the order of its id all the same
+            self.spilled += 1
+            if data is None or task.done is not None:
+                self.held[task.queue_id] = task
+        else:
+            self.items.append(task)
+            self.loaded = task.queue_id
+            self.readable.set()
+
+    async def put(self, task):
+        self.put_nowait(task)
+
+    def get_nowait(self):
+        if not self.items:
+            raise asyncio.QueueEmpty
+        self.outstanding += 1
+        task = self.items.popleft()
+        self.make_room()
+        return task
+
+    async def get(self):
+        while not self.items:
+            self.readable.clear()
+            await self.readable.wait()
+        return self.get_nowait()
+
+    def task_done(self):
+        if self.unfinished <= 0:
+            raise ValueError("task_done() called too many times")
+        self.unfinished -= 1
+        if not self.unfinished:
+            self.finished.set()
+
+    async def join(self):
+        await self.finished.wait()
+
+    def ack(self, task):
+        '''
+        The dispatcher is done with the task, it won't be replayed.
+        '''
+        if task.queue_id is not None:
+            if task.queue_id in self.unstored:
+                self.unstored.discard(task.queue_id)
+            elif self.unwritten.pop(task.queue_id, None) is None:
+                self.acked.append(task.queue_id)
+            task.queue_id = None
+        self.outstanding -= 1
+        self.task_done()
+        self.make_room()
+
+    def make_room(self):
+        # Reads spilled tasks back once the tasks in memory drop to half the window
+        if self.spilled and not self.refilling and len(self.items) + self.outstanding < self.window // 2:
+            self.refilling = True
+            asyncio.create_task(self.refill())
+
+    # --- DISK ---
+
+    def open(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=FULL")  # Every commit is synced, there is one per flush
+        connection.execute("CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, task TEXT)")
+        connection.commit()
+        return connection
+
+    def count(self):
+        # Tasks on disk and the highest id among them
+        with self.lock:
+            total, last_id = self.connection.execute("SELECT COUNT(*), MAX(id) FROM tasks").fetchone()
+        return total, last_id or 0
+
+    def read(self, after, limit):
+        with self.lock:
+            return self.connection.execute("SELECT id, task FROM tasks WHERE id > ? ORDER BY id LIMIT ?", (after, limit)).fetchall()
+
+    def write(self, rows, acked):
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO tasks (id, task) VALUES (?, ?)", rows)
+            self.connection.executemany("DELETE FROM tasks WHERE id = ?", [(task_id,) for task_id in acked])
+
+    def build(self, rows):
+        built = []
+        for task_id, data in rows:
+            if task_id in self.held:
+                built.append(self.held.pop(task_id))  # The same task, with its done future
+                continue
+            try:
+                task = tasks.load(*json.loads(data))
+            except (TypeError, ValueError) as e:
+                print(f"Dropping queued task {task_id} that can't be loaded: {e}")
+                self.acked.append(task_id)
+                self.task_done()
+                continue
+            task.queue_id = task_id
+            task.enqueued_at = time.perf_counter()
+            built.append(task)
+        return built
+
+    async def start(self):
+        '''
+        Opens the file and puts back in the queue the tasks of the previous run, before any put since the process started.
+        '''
+        self.connection = await asyncio.to_thread(self.open)
+        total, last_id = await asyncio.to_thread(self.count)
+        self.renumber(last_id)
+        if total:
+            rows = await asyncio.to_thread(self.read, 0, self.window)
+            self.unfinished += total
+            self.finished.clear()
+            replayed = self.build(rows)
+            if total > len(rows):
+                # Some stay on disk. The tasks put before start have later ids, so they wait behind them
+                for task in self.items:
+                    if task.queue_id in self.unstored or task.done is not None:
+                        self.held[task.queue_id] = task
+                self.spilled += total - len(rows) + len(self.items)
+                self.items = deque()
+                self.loaded = rows[-1][0]
+            else:
+                self.loaded = max(self.loaded, rows[-1][0])
+            self.items.extendleft(reversed(replayed))
+            self.readable.set()
+            print(f"Replaying {total} queued tasks from {self.path}")
+        self.flusher = asyncio.create_task(self.run())
+
+    def renumber(self, last_id):
+        '''
+        Ids come from the clock, which may be behind the ids left on disk (an NTP step, a restored VM). New ids continue
+        from the highest one on disk, and the tasks put before start get new ones, in order, so they still go after it.
+        '''
+        put = sorted({*self.unwritten, *self.unstored})
+        self.last_id = max(self.last_id, last_id)
+        if not put or put[0] > last_id:
+            return
+        ids = {old: self.next_id() for old in put}
+        self.unwritten = {ids[task_id]: data for task_id, data in self.unwritten.items()}
+        self.unstored = {ids[task_id] for task_id in self.unstored}
+        self.held = {ids[task_id]: task for task_id, task in self.held.items()}
+        for task in (*self.items, *self.held.values()):
+            task.queue_id = ids[task.queue_id]
+        self.loaded = ids.get(self.loaded, self.loaded)
+
+    async def refill(self):
+        try:
+            while self.spilled and len(self.items) + self.outstanding < self.window // 2:
+                room = self.window - len(self.items) - self.outstanding
+                # The first spilled task that is not on disk yet, taken before reading in case its flush ends meanwhile
+                end = min((task_id for task_id in (*self.unwritten, *self.writing) if task_id > self.loaded), default=math.inf)
+                rows = await asyncio.to_thread(self.read, self.loaded, room)
+                if len(rows) == room:
+                    end = min(end, rows[-1][0] + 1)  # More rows may follow
+                rows = [row for row in rows if row[0] < end]
+                read = {task_id for task_id, data in rows}
+                kept = sorted(task_id for task_id in self.held if self.loaded < task_id < end and task_id not in read)
+                if not rows and not kept:
+                    return  # The rest is still in unwritten, the next flush calls this again
+                self.loaded = max(rows[-1][0] if rows else 0, kept[-1] if kept else 0)
+                self.spilled -= len(rows) + len(kept)
+                built = self.build(rows) + [self.held.pop(task_id) for task_id in kept]
+                built.sort(key=lambda task: task.queue_id)
+                self.items.extend(built)
+                self.readable.set()
+        except Exception as e:
+            print(f"Error reading queued tasks: {e}")
+        finally:
+            self.refilling = False
+
+    async def flush(self):
+        if not (self.unwritten or self.acked) or self.connection is None:
+            return
+        unwritten, self.unwritten = self.unwritten, {}
+        acked, self.acked = self.acked, []
+        self.writing = unwritten
+        try:
+            await asyncio.to_thread(self.write, list(unwritten.items()), acked)
+        except Exception:
+            self.unwritten = {**unwritten, **self.unwritten}
+            self.acked = acked + self.acked
+            raise
+        finally:
+            self.writing = {}
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error writing queued tasks: {e}")
+            self.make_room()  # Spilled tasks that were still unwritten can be read now
+
+    async def stop(self):
+        '''
+        Writes what is pending, the tasks that were not acknowledged are replayed by the next start.
+        '''
+        if self.flusher:
+            self.flusher.cancel()
+            await asyncio.gather(self.flusher, return_exceptions=True)
+            self.flusher = None
+        await self.flush()
+        if self.connection:
+            await asyncio.to_thread(self.connection.close)
+            self.connection = None
+
+
+def open_queue(kind=TASK_QUEUE, path=TASK_QUEUE_PATH):
+    if kind == "memory":
+        return MemoryQueue()
+    if kind == "sqlite":
+        return SQLiteQueue(path)
+    raise ValueError(f"Unknown task queue: {kind}")
@@ -0,0 +1,197 @@
+import os
+import time
+import tasks
+import metrics
+import state_machine as sm
+from collections import OrderedDict
+from dispatcher import Dispatcher, DISPATCHER_WORKERS
+from rate_limit import RateLimiter
+from markup import MarkupBuilder
+from media_cache import MediaCache
+from downloads import DownloadService
+from sharding import ShardedRunner, SHARDS
+
+EDIT_CACHE_SIZE = int(os.getenv("EDIT_CACHE_SIZE", "10000"))  # Messages whose last edit is remembered to skip repeating it
+
+
+class Engine:
+    '''
+    Executes the tasks of sm.task_queue through a Transport. Everything here is shared by the front-ends, only the transport changes.
+    '''
+    def __init__(self, transport, workers=DISPATCHER_WORKERS, limiter=None, shards=SHARDS):
+        self.transport = transport
+        self.shards = ShardedRunner(shards) if shards else None  # Worker processes that run the state machine, see sharding.py
+        self.markups = MarkupBuilder(transport.keyboard, transport.inline_keyboard, transport.remove_keyboard, named=sm.named_keyboards, callbacks=sm.callback_store)
+        self.media = MediaCache(sm.saved_messages.backend)  # Persisted in the same backend as the saved messages, if there is one
+        self.downloads = sm.downloads = DownloadService(transport)
+        self.last_edits = OrderedDict()  # (chat_id, message_id) -> content of the last edit sent
+        self.dispatcher = Dispatcher(self.execute_task, workers, limiter or RateLimiter(), transport.retry_after, classify=transport.classify)
+        self.timings = {}  # Task type -> histogram of how long executing it takes (mostly the Telegram API call)
+        self.metrics_server = None
+
+        # Task type -> method that executes it. New task types are added with register
+        self.handlers = {
+            tasks.MessageTask: self.send_message,
+            tasks.EditMessageTask: self.edit_message,
+            tasks.DeleteTask: self.delete_message,
+            tasks.PhotoTask: self.send_photo,
+            tasks.DocumentTask: self.send_document,
+            tasks.VideoTask: self.send_video,
+            tasks.PollTask: self.send_poll,
+            tasks.RunTask: self.run_step,
+        }
+
+    def register(self, task_type, handler):
+        '''
+        Adds a task type. handler(task) is awaited to execute it, use tasks.register too to make it available by name for add_task.
+        '''
+        self.handlers[task_type] = handler
+
+    async def start(self):
+        await sm.task_queue.start()  # A durable queue puts back the tasks left by the last run
+        self.dispatcher.start()
+        if self.shards:
+            await self.shards.start()
+        if metrics.METRICS_PORT:
+            self.metrics_server = await metrics.start_server()
+
+    async def stop(self):
+        if self.shards:
+            await self.shards.stop()  # First, their last tasks still go through the dispatcher
+        await self.dispatcher.stop()
+        await sm.task_queue.stop()
+        if self.metrics_server:
+            await self.metrics_server.cleanup()
+            self.metrics_server = None
+
+    async def execute_task(self, task) -> None:
+        task_type = type(task)
+        handler = self.handlers.get(task_type)
+        if handler is None:
+            print(f"Unknown task: {task_type.__name__} for user {task.user_id}")
+            return
+
+        timing = self.timings.get(task_type)
+        if timing is None:
+            timing = self.timings[task_type] = metrics.histogram("task_seconds", "Time spent executing each type of task", task=task_type.__name__)
+        start = time.perf_counter()
+        try:
+            await handler(task)
+        except Exception:
+            metrics.inc("task_errors_total", task=task_type.__name__)
+            raise
+        finally:
+            timing.observe(time.perf_counter() - start)
+
+    def is_tolerated(self, error):
+        # Edits and deletes only log Telegram's errors, except flood waits that the dispatcher must see
+        return self.transport.is_api_error(error) and self.transport.retry_after(error) is None
+
+    async def send_message(self, task: tasks.MessageTask) -> None:
+        message_sent = await self.transport.send_message(
+            chat_id=task.user_id,
+            text=task.text,
+            parse_mode=task.parse_mode,
+            disable_web_page_preview=task.disable_web_page_preview,
+            disable_notification=task.disable_notification,
+            protect_content=task.protect_content,
+            reply_to_message_id=await sm.saved_messages.get(task.user_id, task.reply_to_message_id),
+            allow_sending_without_reply=task.allow_sending_without_reply,
+            reply_markup=self.markups.reply_markup(task)
+        )
+        sm.saved_messages.set(task.user_id, task.save, self.transport.message_id(message_sent))
+
+    async def edit_message(self, task: tasks.EditMessageTask) -> None:
+        message_id = await sm.saved_messages.get(task.user_id, task.message_id)
+        content = (task.text, task.parse_mode, task.disable_web_page_preview, task.keyboard, task.inline_keyboard, task.remove_keyboard)
+        if message_id and self.last_edits.get((task.user_id, message_id)) == content:
+            metrics.inc("edits_skipped_total")  # Telegram would answer "message is not modified"
+        elif message_id:
+            try:
+                await self.transport.edit_message_text(
+                    chat_id=task.user_id,
+                    message_id=message_id,
+                    text=task.text,
+                    parse_mode=task.parse_mode,
+                    disable_web_page_preview=task.disable_web_page_preview,
+                    reply_markup=self.markups.reply_markup(task)
+                )
+            except Exception as e:
+                if not self.is_tolerated(e):
+                    raise
+                print(f"Failed to edit message for user {task.user_id}: {e}")
+            else:
+                self.remember_edit((task.user_id, message_id), content)
+        else:
+            print(f"Message ID not found for editing: {task.message_id}")
+
+        sm.saved_messages.set(task.user_id, task.save, message_id)
+
+    def remember_edit(self, key, content):
+        self.last_edits[key] = content
+        self.last_edits.move_to_end(key)
+        if len(self.last_edits) > EDIT_CACHE_SIZE:
+            self.last_edits.popitem(last=False)
+
+    async def delete_message(self, task: tasks.DeleteTask) -> None:
+        message_id = await sm.saved_messages.get(task.user_id, task.message_id)
+        if message_id:
+            try:
+                await self.transport.delete_message(chat_id=task.user_id, message_id=message_id)
+            except Exception as e:
+                if not self.is_tolerated(e):
+                    raise
+                print(f"Failed to delete message for user {task.user_id}: {e}")
+        else:
+            print(f"Message ID not found for deletion: {task.message_id}")
+
+    async def send_photo(self, task: tasks.PhotoTask) -> None:
+        await self.send_media(task, self.transport.send_photo, "photo", task.photo)
+
+    async def send_document(self, task: tasks.DocumentTask) -> None:
+        await self.send_media(task, self.transport.send_document, "document", task.document)
+
+    async def send_video(self, task: tasks.VideoTask) -> None:
+        await self.send_media(task, self.transport.send_video, "video", task.video)
+
+    async def send_media(self, task: tasks.MediaTask, send, kind, media) -> None:
+        reply_to_message_id = await sm.saved_messages.get(task.user_id, task.reply_to_message_id)
+        reply_markup = self.markups.reply_markup(task)
+
+        async def send_as(value):
+            return await send(
+                chat_id=task.user_id,
+                **{kind: value},
+                caption=task.caption,
+                parse_mode=task.parse_mode,
+                disable_notification=task.disable_notification,
+                protect_content=task.protect_content,
+                reply_to_message_id=reply_to_message_id,
+                allow_sending_without_reply=task.allow_sending_without_reply,
+                reply_markup=reply_markup
+            )
+
+        # Uploaded once, then sent by file_id
+        message_sent = await self.media.send(kind, media, send_as, lambda message: self.transport.file_id(message, kind), self.transport.is_invalid_file)
+        sm.saved_messages.set(task.user_id, task.save, self.transport.message_id(message_sent))
+
+    async def send_poll(self, task: tasks.PollTask) -> None:
+        message_sent = await self.transport.send_poll(
+            chat_id=task.user_id,
+            question=task.question,
+            options=task.options,
+            type=task.type,
+            correct_option_id=task.correct_option_id,
+            is_anonymous=task.is_anonymous,
+            open_period=task.open_period,
+            allow_multiple_answers=task.allow_multiple_answers,
+            explanation=task.explanation,
+            explanation_parse_mode=task.explanation_parse_mode,
+            reply_to_message_id=await sm.saved_messages.get(task.user_id, task.reply_to_message_id),
+            allow_sending_without_reply=task.allow_sending_without_reply,
+            reply_markup=self.markups.reply_markup(task)
+        )
+        sm.saved_messages.set(task.user_id, task.save, self.transport.message_id(message_sent))
+
+    async def run_step(self, task: tasks.RunTask) -> None:
+        await sm.submit_step(task.data)
@@ -0,0 +1,52 @@
+'''
+Thread and process pools for the protocols that block (synchronous I/O, CPU work), so they run off the event loop
+and the other chats keep being served. States opt in with add_state(..., blocking="thread" | "process").
+The pools are created the first time they are used and their sizes are set in the .env.
+'''
+import os
+import signal
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "16"))
+PROCESS_POOL_SIZE = int(os.getenv("PROCESS_POOL_SIZE", str(os.cpu_count() or 1)))
+BLOCKING_TIMEOUT = float(os.getenv("BLOCKING_TIMEOUT", "30"))  # Seconds, for the states that don't set their own timeout
+
+KINDS = ("thread", "process")
+pools = {}  # kind -> executor
+
+
+def ignore_sigint():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C is handled by the main process, which shuts the pool down
+
+
+def pool(kind):
+    executor = pools.get(kind)
+    if executor is None:
+        if kind == "thread":
+            executor = ThreadPoolExecutor(THREAD_POOL_SIZE, thread_name_prefix="blocking")
+        elif kind == "process":
+            executor = ProcessPoolExecutor(PROCESS_POOL_SIZE, mp_context=multiprocessing.get_context("spawn"), initializer=ignore_sigint)
+        else:
+            raise ValueError(f"Unknown blocking kind: {kind}. Use one of: {', '.join(KINDS)}")
+        pools[kind] = executor
+    return executor
+
+
+async def run(kind, function, *args, timeout=None):
+    '''
+    Runs function(*args) in the pool of that kind and returns its result. Raises asyncio.TimeoutError after timeout seconds
+    (BLOCKING_TIMEOUT if None). A call that didn't start yet is cancelled, one that is running can't be interrupted: it
+    keeps its worker until it returns and the result is dropped.
+    With "process" the function must be defined at module level and its arguments and result must be picklable.
+    '''
+    future = asyncio.get_running_loop().run_in_executor(pool(kind), function, *args)
+    return await asyncio.wait_for(future, BLOCKING_TIMEOUT if timeout is None else timeout)
+
+
+def shutdown():
+    # Calls that didn't start are dropped, running ones are not waited for
+    for executor in pools.values():
+        executor.shutdown(wait=False, cancel_futures=True)
+    pools.clear()
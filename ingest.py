@@ -0,0 +1,146 @@
+'''
+The stage between the front-end handlers and sm.submit_step. The handlers call sm.updates.submit(data, ...) and it:
+
+- drops updates it already saw, by the key the handler gives (the update_id, or the chat and message id). A bounded
+  window of the last UPDATE_DEDUPE_WINDOW keys is kept, enough for the updates Telegram delivers again when polling
+  restarts or a webhook call is retried
+- drops a press of the same inline button of the same message within CALLBACK_TAP_MS of the last one (double taps)
+- merges the items of an album (updates sharing a media_group_id) into one step, once ALBUM_WAIT_MS pass without a new
+  item: data = {"id", "media_group_id", "caption", "album": [data of each item, in order]}
+- with UPDATE_DEBOUNCE_MS, merges the text messages a user sends within that time of each other into one step:
+  data["message"] is the texts joined by new lines and data["messages"] the list
+
+Any other update of a user with a pending album or burst sends that one first, so the steps keep the order of the updates.
+'''
+import os
+import math
+import time
+import asyncio
+from collections import OrderedDict
+
+import metrics
+
+UPDATE_DEDUPE_WINDOW = int(os.getenv("UPDATE_DEDUPE_WINDOW", "10000"))
+CALLBACK_TAP = float(os.getenv("CALLBACK_TAP_MS", "1000")) / 1000  # 0 lets every press through
+ALBUM_WAIT = float(os.getenv("ALBUM_WAIT_MS", "500")) / 1000  # 0 sends each item of an album as its own step
+UPDATE_DEBOUNCE = float(os.getenv("UPDATE_DEBOUNCE_MS", "0")) / 1000  # 0 sends each message as its own step
+
+ALBUM_MAX = 10  # Telegram doesn't put more items in an album
+BURST_MAX = 50
+
+
+class Burst:
+    __slots__ = ("group", "items", "handle")
+
+    def __init__(self, group):
+        self.group = group  # ("album", media_group_id) or ("text",)
+        self.items = []
+        self.handle = None
+
+
+class Ingest:
+    def __init__(self, window=UPDATE_DEDUPE_WINDOW, tap=CALLBACK_TAP, album_wait=ALBUM_WAIT, debounce=UPDATE_DEBOUNCE):
+        self.window = window
+        self.tap = tap
+        self.album_wait = album_wait
+        self.debounce = debounce
+        self.recent = OrderedDict()  # key -> monotonic time until which it counts as seen
+        self.pending = {}  # user_id -> Burst waiting to be sent
+        self.flushing = set()  # Flushes started by a timer, kept here so they are not garbage collected
+        self.submit_step = None  # sm.submit_step, given to start()
+        self.blocked_users = None  # sm.blocked_users, given to start()
+
+    def seen(self, key, ttl=None):
+        '''
+        Returns True if key was seen (in the last ttl seconds, if given), else remembers it and returns False.
+        '''
+        now = time.monotonic()
+        until = self.recent.get(key)
+        if until is not None and until > now:
+            return True
+        self.recent[key] = now + ttl if ttl else math.inf
+        self.recent.move_to_end(key)
+        if len(self.recent) > self.window:
+            self.recent.popitem(last=False)
+        return False
+
+    async def submit(self, data, state=None, key=None, tap=None, media_group_id=None):
+        '''
+        Sends the update to the state machine as submit_step(data, state) would, unless it is a duplicate or it is held to
+        be merged. key identifies the update, tap is (message, callback_data) of a pressed button and media_group_id the
+        album of a media message.
+        '''
+        user_id = data.get("id")
+        if key is not None and self.seen(("update", key)):
+            metrics.inc("updates_duplicate_total", reason="update")
+            return
+        if tap is not None and self.tap and self.seen(("tap", user_id, *tap), self.tap):
+            metrics.inc("updates_duplicate_total", reason="tap")
+            return
+        if self.blocked_users is not None and user_id in self.blocked_users:  # Writing to the bot again means it was unblocked
+            await self.blocked_users.discard(user_id)
+
+        if media_group_id is not None and self.album_wait:
+            group, wait, limit = ("album", media_group_id), self.album_wait, ALBUM_MAX
+        elif self.debounce and state is None and "message" in data:
+            group, wait, limit = ("text",), self.debounce, BURST_MAX
+        else:
+            group = None
+
+        burst = self.pending.get(user_id)
+        if burst is not None and burst.group != group:
+            await self.flush(user_id)
+            burst = None
+        if group is None:
+            await self.submit_step(data, state)
+            return
+
+        if burst is None:
+            burst = self.pending[user_id] = Burst(group)
+        else:
+            burst.handle.cancel()
+            metrics.inc("updates_merged_total")
+        burst.items.append(data)
+        if len(burst.items) >= limit:
+            await self.flush(user_id)
+        else:
+            burst.handle = asyncio.get_running_loop().call_later(wait, self.expire, user_id)
+
+    def expire(self, user_id):
+        flush = asyncio.create_task(self.flush_expired(user_id))
+        self.flushing.add(flush)
+        flush.add_done_callback(self.flushing.discard)
+
+    async def flush_expired(self, user_id):
+        try:
+            await self.flush(user_id)
+        except Exception as e:
+            print(f"Error submitting merged updates of user {user_id}: {e}")
+
+    async def flush(self, user_id):
+        burst = self.pending.pop(user_id, None)
+        if burst is None:
+            return
+        if burst.handle:
+            burst.handle.cancel()
+        await self.submit_step(merge(burst))
+
+    async def start(self, submit_step, blocked_users=None):
+        self.submit_step = submit_step
+        self.blocked_users = blocked_users
+
+    async def stop(self):
+        # What is still held goes to the state machine now
+        for user_id in list(self.pending):
+            await self.flush(user_id)
+
+
+def merge(burst):
+    first = burst.items[0]
+    if burst.group[0] == "album":
+        caption = next((item.get("caption") for item in burst.items if item.get("caption")), None)
+        return {"id": first.get("id"), "media_group_id": burst.group[1], "caption": caption, "album": burst.items}
+    if len(burst.items) == 1:
+        return first
+    messages = [item["message"] for item in burst.items]
+    return {**first, "message": "\n".join(messages), "messages": messages}
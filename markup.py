@@ -0,0 +1,74 @@
+import os
+from collections import OrderedDict
+
+MARKUP_CACHE_SIZE = int(os.getenv("MARKUP_CACHE_SIZE", "1024"))
+
+
+class FrozenDict(dict):
+    # A structured callback payload inside a frozen layout, still a dict for the code that reads it
+    def __hash__(self):
+        return hash(tuple(sorted(self.items())))
+
+
+def freeze(layout):
+    '''
+    Turns the nested lists (and dicts) of a keyboard layout into nested tuples, so it can be used as a dict key.
+    '''
+    if isinstance(layout, (list, tuple)):
+        return tuple(freeze(item) for item in layout)
+    if isinstance(layout, dict) and not isinstance(layout, FrozenDict):
+        return FrozenDict((key, freeze(value)) for key, value in layout.items())
+    return layout
+
+
+class MarkupBuilder:
+    '''
+    Builds reply markups with the classes of one library and keeps the last cache_size of them, so the same menu is only built once.
+    keyboard(rows) gets rows of captions, inline_keyboard(rows) gets rows of (caption, callback_data) and remove_keyboard() takes no arguments.
+    A layout can also be the name of a keyboard in named (the ones declared with add_state).
+    If callbacks (a callbacks.CallbackStore) is given, the callback data of inline buttons is encoded with it first, and a
+    cached markup with stored payloads touches them every time it is used, so they are not dropped while it is still sent.
+    '''
+    def __init__(self, keyboard, inline_keyboard, remove_keyboard, named=None, cache_size=MARKUP_CACHE_SIZE, callbacks=None):
+        self.builders = {"keyboard": keyboard, "inline_keyboard": inline_keyboard}
+        self.callbacks = callbacks
+        self.remove = remove_keyboard()  # Always the same, one instance is enough
+        self.named = named if named is not None else {}
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # (kind, frozen layout) -> (markup, keys of the stored payloads in it)
+
+    def build(self, kind, layout):
+        if kind != "inline_keyboard" or not self.callbacks:
+            return self.builders[kind](layout), ()
+        rows = [[(caption, self.callbacks.encode(data)) for caption, data in row] for row in layout]
+        keys = tuple(data for row in rows for caption, data in row if self.callbacks.is_key(data))
+        return self.builders[kind](rows), keys
+
+    def get(self, kind, layout):
+        if isinstance(layout, str):
+            layout = self.named[layout]
+        try:
+            key = (kind, layout if isinstance(layout, tuple) else freeze(layout))
+            cached = self.cache.get(key)
+        except TypeError:
+            return self.build(kind, layout)[0]  # Something in the layout is not hashable, build it every time
+
+        if cached is None or (cached[1] and not self.callbacks.touch(cached[1])):
+            cached = self.cache[key] = self.build(kind, layout)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        return cached[0]
+
+    def reply_markup(self, task):
+        '''
+        Returns the reply_markup for a task from its keyboard, inline_keyboard and remove_keyboard, or None.
+        '''
+        keyboard = self.get("keyboard", task.keyboard) if task.keyboard else None
+        keyboard = self.remove if task.remove_keyboard else keyboard
+        inline_keyboard = self.get("inline_keyboard", task.inline_keyboard) if task.inline_keyboard else None
+
+        if keyboard and inline_keyboard:
+            raise ValueError("Cannot use both keyboard and inline_keyboard in the same message. Please choose one or the other.")
+        return keyboard if keyboard else inline_keyboard
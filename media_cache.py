@@ -0,0 +1,141 @@
+'''
+Uploads each photo, document or video once and sends it by file_id from then on. Local files are identified by the hash
+of their content (read in chunks, never whole) and URLs by their normalized form, so the same media sent to many users,
+or under another path, is only uploaded the first time. file_ids, bytes objects and open files are sent as they are.
+'''
+import os
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", "10000"))  # Entries kept in memory
+MEDIA_CACHE_TTL = float(os.getenv("MEDIA_CACHE_TTL", str(30 * 24 * 3600)))  # Seconds a file_id is kept in the backend
+CHUNK_SIZE = 1024 * 1024
+
+NAMESPACE = "media"
+
+
+def normalize_url(url):
+    # Same resource, same key: case of scheme and host, default ports, order of the query and fragments don't matter
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    port = parts.port
+    netloc = host if port is None or (scheme, port) in (("http", 80), ("https", 443)) else f"{host}:{port}"
+    if parts.username:
+        netloc = f"{parts.username}@{netloc}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+def hash_file(path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaCache:
+    '''
+    Maps media keys to Telegram file_ids. The least recently used entries are dropped from memory past max_entries.
+    If a storage backend is given, file_ids are also written to it (expiring after ttl) and looked up there on a miss.
+    '''
+    def __init__(self, backend=None, max_entries=MEDIA_CACHE_SIZE, ttl=MEDIA_CACHE_TTL):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.file_ids = OrderedDict()  # key -> file_id
+        self.digests = OrderedDict()  # path -> (size, mtime, digest), so unchanged files are not hashed again
+        self.uploads = {}  # key -> future resolved when the upload that is running for it ends
+
+    async def key(self, kind, media):
+        '''
+        Returns the cache key of media, or None if it is not cached (file_ids, open files).
+        The kind is part of the key, a file_id of a photo can't be sent as a document.
+        '''
+        if isinstance(media, (bytes, bytearray)):
+            return f"{kind}:data:{hashlib.blake2b(media, digest_size=20).hexdigest()}"
+        if not isinstance(media, (str, os.PathLike)):
+            return None
+        if isinstance(media, str) and media[:8].lower().startswith(("http://", "https://")):
+            return f"{kind}:url:{normalize_url(media)}"
+        path = os.fspath(media)
+        if not os.path.isfile(path):
+            return None  # A file_id
+        stat = os.stat(path)
+        known = self.digests.get(path)
+        if known and known[:2] == (stat.st_size, stat.st_mtime_ns):
+            self.digests.move_to_end(path)
+            return f"{kind}:file:{known[2]}"
+        digest = await asyncio.to_thread(hash_file, path)
+        self.digests[path] = (stat.st_size, stat.st_mtime_ns, digest)
+        if len(self.digests) > self.max_entries:
+            self.digests.popitem(last=False)
+        return f"{kind}:file:{digest}"
+
+    async def get(self, key):
+        file_id = self.file_ids.get(key)
+        if file_id is None and self.backend:
+            file_id = await asyncio.to_thread(self.backend.load_value, NAMESPACE, key)
+            if file_id is not None:
+                self.remember(key, file_id)
+        elif file_id is not None:
+            self.file_ids.move_to_end(key)
+        return file_id
+
+    def remember(self, key, file_id):
+        self.file_ids[key] = file_id
+        self.file_ids.move_to_end(key)
+        if len(self.file_ids) > self.max_entries:
+            self.file_ids.popitem(last=False)
+
+    async def set(self, key, file_id):
+        self.remember(key, file_id)
+        if self.backend:
+            await asyncio.to_thread(self.backend.save_values, NAMESPACE, [(key, file_id, time.time() + self.ttl)])
+
+    async def forget(self, key):
+        self.file_ids.pop(key, None)
+        if self.backend:
+            await asyncio.to_thread(self.backend.save_values, NAMESPACE, [(key, None, None)])
+
+    async def send(self, kind, media, send, file_id, stale):
+        '''
+        Sends media with send(value), where value is the cached file_id or media itself, and returns the sent message.
+        file_id(message) extracts the file_id of an upload. If sending a cached file_id fails with an error for which
+        stale(error) is true, the entry is dropped and the media uploaded again.
+        While media is being uploaded, other sends of the same media wait for it instead of uploading it too.
+        '''
+        key = await self.key(kind, media)
+        if key is None:
+            return await send(media)
+
+        while True:
+            cached = await self.get(key)
+            if cached is not None:
+                try:
+                    return await send(cached)
+                except Exception as e:
+                    if not stale(e):
+                        raise
+                    print(f"Cached {kind} is not valid anymore, uploading it again: {e}")
+                    await self.forget(key)
+
+            upload = self.uploads.get(key)
+            if upload is None:
+                break
+            await upload  # If it failed there is still nothing cached and this send uploads it
+
+        upload = self.uploads[key] = asyncio.get_running_loop().create_future()
+        try:
+            message = await send(media)
+            uploaded = file_id(message)
+            if uploaded is not None:
+                await self.set(key, uploaded)
+            return message
+        finally:
+            del self.uploads[key]
+            upload.set_result(None)
@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import asyncio
+from collections import OrderedDict
+
+from storage import WriteBehind, FLUSH_INTERVAL
+
+SAVED_MESSAGES_MAX = int(os.getenv("SAVED_MESSAGES_MAX", "100000"))
+SAVED_MESSAGES_TTL = float(os.getenv("SAVED_MESSAGES_TTL", str(48 * 3600)))  # After 48 hours bots can't delete a message anymore
+PRUNE_INTERVAL = 3600  # How often expired entries are removed from memory and from the backend
+
+NAMESPACE = "saved_messages"
+
+
+class MessageRegistry:
+    '''
+    Message ids saved with save="name", kept per (user_id, name) so two users saving "menu" don't overwrite each other.
+    Entries expire after ttl seconds and the least recently used ones are dropped past max_entries.
+    If a storage backend is given, entries are also written to it in batches and looked up there on a miss.
+    '''
+    def __init__(self, backend=None, max_entries=SAVED_MESSAGES_MAX, ttl=SAVED_MESSAGES_TTL, flush_interval=FLUSH_INTERVAL):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (user_id, name) -> (message_id, expires)
+        self.writer = WriteBehind(backend, NAMESPACE, flush_interval, every=self.prune_expired)  # storage key -> [message_id, expires]
+        self.pruned = time.time()
+
+    async def get(self, user_id, name):
+        '''
+        Returns the message id saved under name for this user, or None.
+        '''
+        if name is None:
+            return None
+        entry = self.entries.get((user_id, name))
+        if entry is None and self.backend:
+            key = json.dumps([user_id, name])
+            entry = self.writer.get(key)
+            if entry is None:
+                entry = await asyncio.to_thread(self.backend.load_value, NAMESPACE, key)
+            if entry is not None:
+                entry = tuple(entry)
+                self.entries[(user_id, name)] = entry
+                self.evict()
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del self.entries[(user_id, name)]
+            return None
+        self.entries.move_to_end((user_id, name))
+        return entry[0]
+
+    def set(self, user_id, name, message_id):
+        if name is None or message_id is None:
+            return
+        entry = (message_id, time.time() + self.ttl)
+        self.entries[(user_id, name)] = entry
+        self.entries.move_to_end((user_id, name))
+        if self.backend:
+            self.writer.put(json.dumps([user_id, name]), list(entry), entry[1])
+        self.evict()
+
+    def evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def flush(self):
+        await self.writer.flush()
+
+    def prune(self, now):
+        for key in [key for key, (message_id, expires) in self.entries.items() if expires <= now]:
+            del self.entries[key]
+
+    async def prune_expired(self):
+        now = time.time()
+        if now - self.pruned > PRUNE_INTERVAL:
+            self.pruned = now
+            self.prune(now)
+            if self.backend:
+                await asyncio.to_thread(self.backend.prune_values, now)
+
+    def start(self):
+        # Also without a backend, so expired entries leave memory
+        self.writer.start()
+
+    async def stop(self):
+        await self.writer.stop()
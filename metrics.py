@@ -0,0 +1,179 @@
+'''
+Low-overhead metrics: histograms with fixed buckets, counters and gauges, kept in memory.
+snapshot() returns them as a dict and render() in the Prometheus text format, which start_server serves on /metrics.
+'''
+import os
+import math
+from bisect import bisect_left
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 means no metrics server
+
+# Seconds, from half a millisecond to ten seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+
+histograms = {}  # (name, labels) -> Histogram
+counters = {}  # (name, labels) -> value
+gauges = {}  # (name, labels) -> function that returns the current value
+descriptions = {}  # name -> help text
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        '''
+        Upper bound of the bucket where the q quantile falls, good enough to compare runs.
+        '''
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return math.inf
+
+
+def histogram(name, description="", **labels):
+    '''
+    Returns the histogram for name and labels, creating it the first time. Keep the result around in hot paths.
+    '''
+    key = (name, tuple(sorted(labels.items())))
+    found = histograms.get(key)
+    if found is None:
+        found = histograms[key] = Histogram()
+        if description:
+            descriptions.setdefault(name, description)
+    return found
+
+
+def observe(name, value, **labels):
+    histogram(name, **labels).observe(value)
+
+
+def inc(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    counters[key] = counters.get(key, 0) + amount
+
+
+def gauge(name, function, description="", **labels):
+    '''
+    Registers a gauge, function() is called every time the metrics are read.
+    '''
+    gauges[(name, tuple(sorted(labels.items())))] = function
+    if description:
+        descriptions.setdefault(name, description)
+
+
+def describe(name, description):
+    descriptions[name] = description
+
+
+def snapshot():
+    '''
+    Returns every metric as plain values: {"histograms": {...}, "counters": {...}, "gauges": {...}}, keyed by name{labels}.
+    '''
+    result = {"histograms": {}, "counters": {}, "gauges": {}}
+    for (name, labels), found in histograms.items():
+        result["histograms"][series(name, labels)] = {
+            "count": found.count,
+            "sum": found.sum,
+            "p50": found.quantile(0.5),
+            "p99": found.quantile(0.99),
+            "buckets": dict(zip(BUCKETS, found.counts)),
+        }
+    for (name, labels), value in counters.items():
+        result["counters"][series(name, labels)] = value
+    for (name, labels), function in gauges.items():
+        result["gauges"][series(name, labels)] = function()
+    return result
+
+
+def series(name, labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def bound(value):
+    return "+Inf" if value == math.inf else repr(value)
+
+
+def order(item):
+    # Series of the same metric must be together, label values may be of any type
+    (name, labels), value = item
+    return name, str(labels)
+
+
+def render():
+    '''
+    Returns every metric in the Prometheus text exposition format.
+    '''
+    lines = []
+    described = set()
+
+    def header(name, kind):
+        if name not in described:
+            described.add(name)
+            if name in descriptions:
+                lines.append(f"# HELP {name} {descriptions[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), found in sorted(histograms.items(), key=order):
+        header(name, "histogram")
+        seen = 0
+        for upper, count in zip(BUCKETS, found.counts):
+            seen += count
+            lines.append(f"{series(name + '_bucket', labels, [('le', bound(upper))])} {seen}")
+        lines.append(f"{series(name + '_sum', labels)} {found.sum}")
+        lines.append(f"{series(name + '_count', labels)} {found.count}")
+    for (name, labels), value in sorted(counters.items(), key=order):
+        header(name, "counter")
+        lines.append(f"{series(name, labels)} {value}")
+    for (name, labels), function in sorted(gauges.items(), key=order):
+        header(name, "gauge")
+        lines.append(f"{series(name, labels)} {function()}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    histograms.clear()
+    counters.clear()
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    '''
+    Serves /metrics (Prometheus text) and /metrics.json (snapshot) on a local port. Returns the runner, call runner.cleanup() to stop it.
+    '''
+    from aiohttp import web  # Only needed for the server, the rest of this module is imported everywhere
+
+    async def handle_metrics(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    async def handle_snapshot(request):
+        return web.json_response(snapshot())
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/metrics.json", handle_snapshot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -1,17 +1,20 @@
 import os
 from dotenv import load_dotenv
-import telegram
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, BotCommand
+from telegram import Update, BotCommand
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import asyncio
-import state_machine as sm
 
 
-load_dotenv()
+load_dotenv() # Before importing our modules, they read their settings from the environment when imported
+
+import state_machine as sm
+import webhook
+from engine import Engine
+from transport_ptb import PTBTransport
 
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 
-saved_messages = {}
+engine = None
 
 async def post_init(application):
     '''
@@ -19,7 +22,16 @@ async def post_init(application):
     '''
     await set_bot_commands(application)
     await sm.start_state_machine()
-    asyncio.create_task(task_handler(application))
+    await task_handler(application)
+
+
+async def post_stop(application):
+    '''
+    This function is called when the bot is stopping. It lets the steps already received run, then the dispatcher send what is left in the queue, stops its workers and saves the users that changed.
+    '''
+    await sm.drain_state_machine()
+    await engine.stop()
+    await sm.stop_state_machine()
 
 
 async def set_bot_commands(application):
@@ -36,8 +48,7 @@ async def start_command_handler(update: Update, context: ContextTypes.DEFAULT_TY
     This function handles the /start command.
     '''
     user_id = update.effective_user.id 
-    sm.set_user_state(user_id, "START")
-    await sm.run_state_machine_step({"id": user_id})
+    await sm.updates.submit({"id": user_id}, state="START", key=update.update_id)
     
 
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -46,289 +57,86 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     '''
     text = update.message.text
     data = {"id": update.effective_user.id, "message": text}
-    await sm.run_state_machine_step(data)
-    #asyncio.create_task(sm.run_state_machine_step(data))
+    await sm.updates.submit(data, key=update.update_id)
 
 async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     '''
-    This function handles all callback queries from inline keyboards. It sends the callback data and user ID to the state machine to be processed.
+    This function handles all callback queries from inline keyboards. It decodes the callback data (structured payloads give a route and its args) and sends it with the user ID to the state machine to be processed.
+    A second press of the same button right after the first one is dropped.
     '''
-    query_data = update.callback_query.data
+    query = update.callback_query
+    route, args = await sm.callback_store.decode(query.data)
     user_id = update.effective_user.id
-    data = {"id": user_id, "callback_data": query_data}
-    await sm.run_state_machine_step(data)
-    #asyncio.create_task(sm.run_state_machine_step(data))
+    data = {"id": user_id, "callback_data": route, "callback_args": args}
+    button = (query.message.message_id if query.message else query.inline_message_id, query.data)
+    await sm.updates.submit(data, key=update.update_id, tap=button)
 
 async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     '''
-    This function handles all photo messages. It sends the file ID of the photo and user ID to the state machine to be processed.
+    This function handles all photo messages. It sends the file ID of the photo, its unique ID (to download it with sm.downloads) and the user ID to the state machine to be processed.
+    The photos and videos of an album reach the state machine together, in one step with data["album"].
     '''
-    photo_file_id = update.message.photo[-1].file_id # Get the file ID of the highest resolution photo
+    photo = update.message.photo[-1] # The highest resolution photo
     user_id = update.effective_user.id
     caption = update.message.caption
-    data = {"id": user_id, "photo_file_id": photo_file_id, "caption": caption}
-    await sm.run_state_machine_step(data)
-    #asyncio.create_task(sm.run_state_machine_step(data))
+    data = {"id": user_id, "photo_file_id": photo.file_id, "file_unique_id": photo.file_unique_id, "file_size": photo.file_size, "caption": caption}
+    await sm.updates.submit(data, key=update.update_id, media_group_id=update.message.media_group_id)
 
 async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     '''
     This function handles all document messages. It sends the file ID of the document and user ID to the state machine to be processed.
     '''
-    document_file_id = update.message.document.file_id
+    document = update.message.document
     user_id = update.effective_user.id
     caption = update.message.caption
-    data = {"id": user_id, "document_file_id": document_file_id, "caption": caption}
-    await sm.run_state_machine_step(data)
-    #asyncio.create_task(sm.run_state_machine_step(data))
+    data = {"id": user_id, "document_file_id": document.file_id, "file_unique_id": document.file_unique_id, "file_size": document.file_size, "caption": caption}
+    await sm.updates.submit(data, key=update.update_id, media_group_id=update.message.media_group_id)
 
 async def video_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     '''
     This function handles all video messages. It sends the file ID of the video and user ID to the state machine to be processed.
     '''
-    video_file_id = update.message.video.file_id
+    video = update.message.video
     user_id = update.effective_user.id
     caption = update.message.caption
-    data = {"id": user_id, "video_file_id": video_file_id, "caption": caption}
-    await sm.run_state_machine_step(data)
-    #asyncio.create_task(sm.run_state_machine_step(data))
+    data = {"id": user_id, "video_file_id": video.file_id, "file_unique_id": video.file_unique_id, "file_size": video.file_size, "caption": caption}
+    await sm.updates.submit(data, key=update.update_id, media_group_id=update.message.media_group_id)
 
 async def task_handler(application):
-    while True:
-        try:
-            user_id, action, params = sm.task_queue.get_nowait()
-            await execute_task(application, user_id, action, params)
-        except asyncio.QueueEmpty:
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            print(f"Error in task_handler: {e}\n\nAction: {action}")
-
-async def execute_task(application, user_id, action, params) -> None:
-    if action == "message":
-        text = params.get("text", None)
-        parse_mode = params.get("parse_mode", None)
-        # entities = params.get("entities", None)
-        disable_web_page_preview = params.get("disable_web_page_preview", None)
-        disable_notification = params.get("disable_notification", None)
-        protect_content = params.get("protect_content", None)
-        reply_to_message_id = saved_messages.get(params.get("reply_to_message_id", None), None)
-        allow_sending_without_reply = params.get("allow_sending_without_reply", None)
-        keyboard = None if not params.get("keyboard", None) else ReplyKeyboardMarkup([[KeyboardButton(text=caption) for caption in row] for row in params.get("keyboard")], resize_keyboard=True)
-        keyboard = telegram.ReplyKeyboardRemove() if params.get("remove_keyboard", False) else keyboard
-        inline_keyboard = None if not params.get("inline_keyboard", None) else telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(text=caption, callback_data=data) for caption, data in row] for row in params.get("inline_keyboard")])
-        # message_thread_id = params.get("message_thread_id", None)
-
-        if keyboard and inline_keyboard:
-            raise ValueError("Cannot use both keyboard and inline_keyboard in the same message. Please choose one or the other.")
-        else:
-            reply_markup = keyboard if keyboard else inline_keyboard
-
-        message_sent = await application.bot.send_message(
-            chat_id=user_id,
-            text=text,
-            parse_mode=parse_mode,
-            # entities=entities,
-            disable_web_page_preview=disable_web_page_preview,
-            disable_notification=disable_notification,
-            protect_content=protect_content,
-            reply_to_message_id=reply_to_message_id,
-            allow_sending_without_reply=allow_sending_without_reply,
-            reply_markup=reply_markup
-            # message_thread_id=message_thread_id
-        )
-        if params.get("save", None):
-            saved_messages[params.get("save")] = message_sent.message_id
-
-    elif action == "editmessage":
-        message_id = saved_messages.get(params.get("message_id", None), None)
-        if message_id:
-            text = params.get("text", None)
-            parse_mode = params.get("parse_mode", None)
-            # entities = params.get("entities", None)
-            disable_web_page_preview = params.get("disable_web_page_preview", None)
-            disable_notification = params.get("disable_notification", None)
-            protect_content = params.get("protect_content", None)
-            keyboard = None if not params.get("keyboard", None) else ReplyKeyboardMarkup([[KeyboardButton(text=caption) for caption in row] for row in params.get("keyboard")], resize_keyboard=True)
-            keyboard = telegram.ReplyKeyboardRemove() if params.get("remove_keyboard", False) else keyboard
-            inline_keyboard = None if not params.get("inline_keyboard", None) else telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(text=caption, callback_data=data) for caption, data in row] for row in params.get("inline_keyboard")])
-
-            if keyboard and inline_keyboard:
-                raise ValueError("Cannot use both keyboard and inline_keyboard in the same message. Please choose one or the other.")
-            else:
-                reply_markup = keyboard if keyboard else inline_keyboard
-
-            try:
-                await application.bot.edit_message_text(
-                    chat_id=user_id,
-                    message_id=message_id,
-                    text=text,
-                    parse_mode=parse_mode,
-                    # entities=entities,
-                    disable_web_page_preview=disable_web_page_preview,
-                    disable_notification=disable_notification,
-                    protect_content=protect_content,
-                    reply_markup=reply_markup
-                )
-            except telegram.error.TelegramError as e:
-                print(f"Failed to edit message for user {user_id}: {e}")
-        else:
-            print(f"Message ID not found for editing: {params.get('message_id', None)}")
-
-    elif action == "delete": 
-        message_id = saved_messages.get(params.get("message_id", None), None)
-        if message_id:
-            try:
-                await application.bot.delete_message(chat_id=user_id, message_id=message_id)
-            except telegram.error.TelegramError as e:
-                print(f"Failed to delete message for user {user_id}: {e}")
-        else:
-            print(f"Message ID not found for deletion: {params.get('message_id', None)}")
-
-    elif action == "photo":
-        photo = params.get("photo", None)
-        caption = params.get("caption", None)
-        parse_mode = params.get("parse_mode", None)
-        disable_notification = params.get("disable_notification", None)
-        protect_content = params.get("protect_content", None)
-        reply_to_message_id = saved_messages.get(params.get("reply_to_message_id", None), None)
-        allow_sending_without_reply = params.get("allow_sending_without_reply", None)
-        keyboard = None if not params.get("keyboard", None) else ReplyKeyboardMarkup([[KeyboardButton(text=caption) for caption in row] for row in params.get("keyboard")], resize_keyboard=True)
-        keyboard = telegram.ReplyKeyboardRemove() if params.get("remove_keyboard", False) else keyboard
-        inline_keyboard = None if not params.get("inline_keyboard", None) else telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(text=caption, callback_data=data) for caption, data in row] for row in params.get("inline_keyboard")])
-
-        if keyboard and inline_keyboard:
-            raise ValueError("Cannot use both keyboard and inline_keyboard in the same message. Please choose one or the other.")
-        else:
-            reply_markup = keyboard if keyboard else inline_keyboard
-
-        message_sent = await application.bot.send_photo(
-            chat_id=user_id,
-            photo=photo, # May be a local file path, a URL, a file ID of an existing Telegram file or a bytes object containing the photo data.
-            caption=caption,
-            parse_mode=parse_mode,
-            disable_notification=disable_notification,
-            protect_content=protect_content,
-            reply_to_message_id=reply_to_message_id,
-            allow_sending_without_reply=allow_sending_without_reply,
-            reply_markup=reply_markup
-        )
-
-        if params.get("save", None):
-            saved_messages[params.get("save")] = message_sent.message_id
-
-    elif action == "document":
-        document = params.get("document", None)
-        caption = params.get("caption", None)
-        parse_mode = params.get("parse_mode", None)
-        disable_notification = params.get("disable_notification", None)
-        protect_content = params.get("protect_content", None)
-        reply_to_message_id = saved_messages.get(params.get("reply_to_message_id", None), None)
-        allow_sending_without_reply = params.get("allow_sending_without_reply", None)
-        keyboard = None if not params.get("keyboard", None) else ReplyKeyboardMarkup([[KeyboardButton(text=caption) for caption in row] for row in params.get("keyboard")], resize_keyboard=True)
-        keyboard = telegram.ReplyKeyboardRemove() if params.get("remove_keyboard", False) else keyboard
-        inline_keyboard = None if not params.get("inline_keyboard", None) else telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(text=caption, callback_data=data) for caption, data in row] for row in params.get("inline_keyboard")])
-
-        if keyboard and inline_keyboard:
-            raise ValueError("Cannot use both keyboard and inline_keyboard in the same message. Please choose one or the other.")
-        else:
-            reply_markup = keyboard if keyboard else inline_keyboard
-
-        message_sent = await application.bot.send_document(
-            chat_id=user_id,
-            document=document, # May be a local file path, a URL, a file ID of an existing Telegram file or a bytes object containing the document data.
-            caption=caption,
-            parse_mode=parse_mode,
-            disable_notification=disable_notification,
-            protect_content=protect_content,
-            reply_to_message_id=reply_to_message_id,
-            allow_sending_without_reply=allow_sending_without_reply,
-            reply_markup=reply_markup
-        )
-
-        if params.get("save", None):
-            saved_messages[params.get("save")] = message_sent.message_id
-    
-    elif action == "video":
-        video = params.get("video", None) # May be a local file path, a URL, a file ID of an existing Telegram file or a bytes object containing the video data.
-        caption = params.get("caption", None)
-        parse_mode = params.get("parse_mode", None)
-        disable_notification = params.get("disable_notification", None)
-        protect_content = params.get("protect_content", None)
-        reply_to_message_id = saved_messages.get(params.get("reply_to_message_id", None), None)
-        allow_sending_without_reply = params.get("allow_sending_without_reply", None)
-        keyboard = None if not params.get("keyboard", None) else ReplyKeyboardMarkup([[KeyboardButton(text=caption) for caption in row] for row in params.get("keyboard")], resize_keyboard=True)
-        keyboard = telegram.ReplyKeyboardRemove() if params.get("remove_keyboard", False) else keyboard
-        inline_keyboard = None if not params.get("inline_keyboard", None) else telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(text=caption, callback_data=data) for caption, data in row] for row in params.get("inline_keyboard")])
-
-        if keyboard and inline_keyboard:
-            raise ValueError("Cannot use both keyboard and inline_keyboard in the same message. Please choose one or the other.")
-        else:
-            reply_markup = keyboard if keyboard else inline_keyboard
-
-        message_sent = await application.bot.send_video(
-            chat_id=user_id,
-            video=video, # May be a local file path, a URL, a file ID of an existing Telegram file or a bytes object containing the video data.
-            caption=caption,
-            parse_mode=parse_mode,
-            disable_notification=disable_notification,
-            protect_content=protect_content,
-            reply_to_message_id=reply_to_message_id,
-            allow_sending_without_reply=allow_sending_without_reply,
-            reply_markup=reply_markup
-        )
-
-        if params.get("save", None):
-            saved_messages[params.get("save")] = message_sent.message_id
-
-    elif action == "poll":
-        question = params.get("question", None)
-        options = params.get("options", None)
-        type = params.get("type", None) # "regular" or "quiz"
-        correct_option_id = params.get("correct_option_id", None)
-        is_anonymous = params.get("is_anonymous", None)
-        open_period = params.get("open_period", None)
-        allow_multiple_answers = params.get("allow_multiple_answers", None)
-        explanation = params.get("explanation", None)
-        explanation_parse_mode = params.get("explanation_parse_mode", None)
-        reply_to_message_id = saved_messages.get(params.get("reply_to_message_id", None), None)
-        allow_sending_without_reply = params.get("allow_sending_without_reply", None)
-        keyboard = None if not params.get("keyboard", None) else ReplyKeyboardMarkup([[KeyboardButton(text=caption) for caption in row] for row in params.get("keyboard")], resize_keyboard=True)
-        keyboard = telegram.ReplyKeyboardRemove() if params.get("remove_keyboard", False) else keyboard
-        inline_keyboard = None if not params.get("inline_keyboard", None) else telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(text=caption, callback_data=data) for caption, data in row] for row in params.get("inline_keyboard")])
-
-        if keyboard and inline_keyboard:
-            raise ValueError("Cannot use both keyboard and inline_keyboard in the same message. Please choose one or the other.")
-        else:
-            reply_markup = keyboard if keyboard else inline_keyboard
+    '''
+    This function starts the engine that executes the tasks of sm.task_queue through application.bot. Its pool size is set with DISPATCHER_WORKERS in the .env file.
+    '''
+    global engine
+    engine = Engine(PTBTransport(application.bot))
+    await engine.start()
 
-        message_sent = await application.bot.send_poll(
-            chat_id=user_id,
-            question=question,
-            options=options,
-            type=type,
-            correct_option_id=correct_option_id,
-            is_anonymous=is_anonymous,
-            open_period=open_period,
-            allow_multiple_answers=allow_multiple_answers,
-            explanation=explanation,
-            explanation_parse_mode=explanation_parse_mode,
-            reply_to_message_id=reply_to_message_id,
-            allow_sending_without_reply=allow_sending_without_reply,
-            reply_markup=reply_markup
-        )
 
-        if params.get("save", None):
-            saved_messages[params.get("save")] = message_sent.message_id
+async def run_webhook(application):
+    '''
+    This function runs the bot in webhook mode. Telegram POSTs the updates to a local aiohttp server, which only puts them in the application's update queue, so they are processed by the same handlers as with polling.
+    '''
+    await application.initialize()
+    # First, so a missing WEBHOOK_SECRET stops it before anything starts. Updates wait in the queue until the application starts
+    runner = await webhook.start_server(lambda payload: application.update_queue.put_nowait(Update.de_json(payload, application.bot)))
+    await post_init(application)
+    await application.bot.set_webhook(url=webhook.WEBHOOK_URL, secret_token=webhook.WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+    await application.start()
+    print(f"Webhook escuchando en {webhook.WEBHOOK_HOST}:{webhook.WEBHOOK_PORT}{webhook.WEBHOOK_PATH}")
 
-    elif action == "run":
-        await sm.run_state_machine_step(params)
-        #asyncio.create_task(sm.run_state_machine_step(data))
-    
-    else:
-        print(f"Unknown action: {action} for user {user_id}")
+    try:
+        await asyncio.Event().wait() # Until Ctrl+C
+    finally:
+        await runner.cleanup()
+        await application.stop()
+        await post_stop(application)
+        await application.shutdown()
 
 
 def main() -> None:
-    application = Application.builder().token(TOKEN).post_init(post_init).build()
+    builder = Application.builder().token(TOKEN).post_init(post_init).post_stop(post_stop)
+    if webhook.WEBHOOK_URL:
+        builder = builder.updater(None) # Updates come from our webhook server instead of the updater
+    application = builder.build()
     application.add_handler(CommandHandler("start", start_command_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
     application.add_handler(MessageHandler(filters.PHOTO, photo_handler))
@@ -337,7 +145,10 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.ALL & filters.UpdateType.CALLBACK_QUERY, callback_query_handler))
 
     print("El bot ha iniciado. Presiona Ctrl+C para detenerlo.")
-    application.run_polling(poll_interval=0.5)
+    if webhook.WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(poll_interval=0.5)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+import os
+import time
+import asyncio
+
+# Telegram's documented limits: ~30 messages per second overall, ~1 per second in a chat and 20 per minute in a group
+GLOBAL_RATE = float(os.getenv("RATE_LIMIT_GLOBAL", "30"))
+CHAT_RATE = float(os.getenv("RATE_LIMIT_CHAT", "1"))
+GROUP_RATE = float(os.getenv("RATE_LIMIT_GROUP_PER_MINUTE", "20")) / 60
+CHAT_BURST = float(os.getenv("RATE_LIMIT_CHAT_BURST", "3"))
+
+
+class TokenBucket:
+    '''
+    Holds up to capacity tokens and refills them at rate tokens per second. Every API call takes one token.
+    '''
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        '''
+        Returns how many seconds until a token is available (0 if there is one right now).
+        '''
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+class RateLimiter:
+    '''
+    Keeps a global bucket and one bucket per chat. Chats can also be parked for the time Telegram asks for in a flood wait.
+    '''
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, group_rate=GROUP_RATE, chat_burst=CHAT_BURST, max_chats=100000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.chats = {}   # chat_id -> TokenBucket
+        self.parked = {}  # chat_id -> monotonic time until which the chat can't receive anything
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= self.max_chats:
+                self.forget_idle_chats()
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate  # Group and channel ids are negative
+            bucket = self.chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def forget_idle_chats(self):
+        '''
+        Drops the buckets that are already full again, they behave exactly like a new one.
+        '''
+        now = time.monotonic()
+        for chat_id, bucket in list(self.chats.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self.chats[chat_id]
+
+    def chat_delay(self, chat_id):
+        '''
+        Returns how many seconds the chat has to wait before the next API call, taking flood waits into account.
+        '''
+        now = time.monotonic()
+        delay = self.chat_bucket(chat_id).delay(now)
+        until = self.parked.get(chat_id)
+        if until is not None:
+            if until > now:
+                delay = max(delay, until - now)
+            else:
+                del self.parked[chat_id]
+        return delay
+
+    def park(self, chat_id, seconds):
+        self.parked[chat_id] = time.monotonic() + seconds
+
+    async def acquire(self, chat_id):
+        '''
+        Waits for a global token and takes it together with the chat's token. Call chat_delay first so the chat is not waited on here.
+        '''
+        delay = self.global_bucket.delay(time.monotonic())
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.global_bucket.delay(time.monotonic())
+        now = time.monotonic()
+        self.global_bucket.take(now)
+        self.chat_bucket(chat_id).take(now)
@@ -0,0 +1,154 @@
+'''
+What happens to a task whose API call failed. The transport classifies the error:
+- flood waits are handled by the dispatcher as before, the chat is parked for the time Telegram asks
+- "retry" (network errors, timeouts, Telegram 5xx) is tried again after a jittered exponential backoff, only that user's
+  line waits meanwhile
+- "blocked" (the user blocked the bot or deleted the account) marks the user, so later sends to them are dropped
+  without calling the API, until they send the bot something again
+- "permanent" (any other error) is not tried again
+Tasks that fail for good go to the dead letters, which can be listed and sent again with replay().
+'''
+import os
+import json
+import time
+import random
+import asyncio
+import itertools
+from collections import OrderedDict
+
+import tasks
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))  # Retries after the first attempt
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_MS", "500")) / 1000
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "60"))
+DEAD_LETTERS_MAX = int(os.getenv("DEAD_LETTERS_MAX", "10000"))
+
+RETRY = "retry"
+BLOCKED = "blocked"
+PERMANENT = "permanent"
+
+transient_errors = (ConnectionError, TimeoutError)  # Connection problems, whatever the library
+
+
+class UserBlocked(Exception):
+    '''
+    Set on the done future of the tasks dropped because the user blocked the bot.
+    '''
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        # Full jitter: a random time up to the exponential backoff, so the retries of many chats don't arrive together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class BlockedUsers:
+    '''
+    Users that blocked the bot. Kept in memory and, if a storage backend is given, in it so they survive a restart.
+    '''
+    NAMESPACE = "blocked_users"
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.users = set()
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    async def load(self):
+        if self.backend:
+            stored = await asyncio.to_thread(self.backend.load_values, self.NAMESPACE)
+            self.users.update(json.loads(key) for key in stored)
+
+    async def add(self, user_id):
+        if user_id in self.users:
+            return
+        self.users.add(user_id)
+        if self.backend:
+            await asyncio.to_thread(self.backend.save_values, self.NAMESPACE, [(json.dumps(user_id), time.time(), None)])
+
+    async def discard(self, user_id):
+        if user_id not in self.users:
+            return
+        self.users.discard(user_id)
+        if self.backend:
+            await asyncio.to_thread(self.backend.save_values, self.NAMESPACE, [(json.dumps(user_id), None, None)])
+
+
+class DeadLetters:
+    '''
+    Tasks that failed for good, with their error, the oldest ones dropped past max_entries. If a storage backend is given
+    they are also kept in it, except those with values that are not JSON (like photos given as bytes).
+    '''
+    NAMESPACE = "dead_letters"
+
+    def __init__(self, backend=None, max_entries=DEAD_LETTERS_MAX):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # id -> {"id", "task", "fields", "error", "kind", "attempts", "time"}
+        self.ids = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    async def load(self):
+        if self.backend:
+            stored = await asyncio.to_thread(self.backend.load_values, self.NAMESPACE)
+            for entry in sorted(stored.values(), key=lambda entry: entry["time"]):
+                self.entries[entry["id"]] = entry
+
+    async def add(self, task, error, kind):
+        name, fields = tasks.dump(task)
+        entry = {
+            "id": f"{time.time_ns()}-{next(self.ids)}",
+            "task": name,
+            "fields": fields,
+            "error": f"{type(error).__name__}: {error}",
+            "kind": kind,
+            "attempts": task.attempts + 1,
+            "time": time.time(),
+        }
+        self.entries[entry["id"]] = entry
+        dropped = []
+        while len(self.entries) > self.max_entries:
+            dropped.append((self.entries.popitem(last=False)[0], None, None))
+        if self.backend:
+            try:
+                json.dumps(entry)
+            except (TypeError, ValueError):
+                items = dropped  # Only in memory
+            else:
+                items = dropped + [(entry["id"], entry, None)]
+            if items:
+                await asyncio.to_thread(self.backend.save_values, self.NAMESPACE, items)
+
+    def list(self, user_id=None):
+        '''
+        Returns the dead letters, oldest first, optionally only those of one user.
+        '''
+        return [entry for entry in self.entries.values() if user_id is None or entry["fields"]["user_id"] == user_id]
+
+    async def remove(self, ids):
+        for entry_id in ids:
+            self.entries.pop(entry_id, None)
+        if self.backend and ids:
+            await asyncio.to_thread(self.backend.save_values, self.NAMESPACE, [(entry_id, None, None) for entry_id in ids])
+
+    async def replay(self, enqueue, ids=None):
+        '''
+        Puts the dead letters (all, or those with these ids) back in the queue with enqueue (sm.enqueue) and removes them.
+        Returns how many were replayed.
+        '''
+        entries = [self.entries[entry_id] for entry_id in ids if entry_id in self.entries] if ids is not None else list(self.entries.values())
+        for entry in entries:
+            await enqueue(tasks.load(entry["task"], entry["fields"]))
+        await self.remove([entry["id"] for entry in entries])
+        return len(entries)
@@ -0,0 +1,220 @@
+'''
+Runs the state machine in several worker processes, so a slow protocol only blocks the users of its process.
+The front process keeps talking to Telegram: sm.submit_step sends each step to the worker that owns the user (chosen
+by consistent hash of the user_id), the worker runs it with its own user_state / user_vault and sends back the tasks
+the protocols queued, which the front process executes as usual. Steps of one user always go to the same worker, so
+they keep their order.
+
+Enabled with SHARDS=N in the .env (0, the default, runs everything in the front process). Data and tasks cross
+processes pickled, so they must only hold picklable values. With STORAGE=memory each worker has its own users,
+use STORAGE=sqlite to keep them when the number of shards changes.
+'''
+import os
+import atexit
+import signal
+import asyncio
+import hashlib
+import itertools
+import multiprocessing
+from bisect import bisect
+from functools import partial
+from queue import Empty
+
+import state_machine as sm
+import durable_queue
+
+SHARDS = int(os.getenv("SHARDS", "0"))  # Worker processes, 0 means no sharding
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "64"))  # Points of each worker on the ring, more spread the users more evenly
+SHARD_BATCH = 100  # Messages read or sent at once between processes
+
+
+def digest(key):
+    # hash() changes between processes, this doesn't
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    '''
+    Consistent hashing: when the number of shards changes only about 1/N of the users move to another shard.
+    '''
+    def __init__(self, shards, vnodes=SHARD_VNODES):
+        points = sorted((digest(f"{shard}:{vnode}"), shard) for shard in range(shards) for vnode in range(vnodes))
+        self.hashes = [point for point, shard in points]
+        self.shards = [shard for point, shard in points]
+
+    def shard(self, user_id):
+        return self.shards[bisect(self.hashes, digest(str(user_id))) % len(self.hashes)]
+
+
+def receive(queue, timeout=0.1):
+    '''
+    Waits up to timeout for a message and returns it with the ones already waiting behind it, or [] if none came.
+    Blocking, run it in a thread.
+    '''
+    try:
+        messages = [queue.get(timeout=timeout)]
+    except Empty:
+        return []
+    while len(messages) < SHARD_BATCH:
+        try:
+            messages.append(queue.get_nowait())
+        except Empty:
+            break
+    return messages
+
+
+# --- FRONT PROCESS ---
+
+class ShardedRunner:
+    '''
+    Starts the worker processes and routes the steps to them. Messages to a worker are ("step", data, state),
+    ("done", token, error) and None to stop it. Workers answer ("tasks", shard, [(token, task), ...]) and ("stopped", shard).
+    '''
+    def __init__(self, shards=SHARDS):
+        # Forking a process with a running event loop and threads is not safe. Workers are not daemons so they can have
+        # their own pools (blocking="process" states), kill() ends them if the front process exits without stopping them
+        context = multiprocessing.get_context("spawn")
+        self.ring = HashRing(shards)
+        self.inboxes = [context.Queue() for _ in range(shards)]
+        self.outbox = context.Queue()
+        self.processes = [
+            context.Process(target=worker_main, args=(shard, shards, self.inboxes[shard], self.outbox), name=f"shard-{shard}")
+            for shard in range(shards)
+        ]
+        self.running = 0
+        self.reader = None
+
+    async def start(self):
+        for process in self.processes:
+            process.start()
+        self.running = len(self.processes)
+        self.reader = asyncio.create_task(self.read())
+        sm.step_router = self.submit_step
+        sm.timers.unload()  # Each worker loads the timers of its users
+        atexit.register(self.kill)
+
+    async def stop(self, timeout=10.0):
+        '''
+        Lets the workers finish their steps and send their last tasks, then waits for them to exit.
+        '''
+        sm.step_router = None
+        for inbox in self.inboxes:
+            inbox.put(None)
+        try:
+            await asyncio.wait_for(self.reader, timeout)
+        except asyncio.TimeoutError:
+            print(f"Shards did not stop in {timeout}s, {self.running} still running")
+        for process in self.processes:
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+        atexit.unregister(self.kill)
+
+    def kill(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+    async def submit_step(self, data, state=None):
+        self.inboxes[self.ring.shard(data.get("id"))].put(("step", data, state))
+
+    async def read(self):
+        loop = asyncio.get_running_loop()
+        while self.running:
+            for message in await asyncio.to_thread(receive, self.outbox):
+                if message[0] == "tasks":
+                    shard = message[1]
+                    for token, task in message[2]:
+                        if token is not None:  # The worker waits for this task, tell it how it went
+                            task.done = loop.create_future()
+                            task.done.add_done_callback(partial(self.report, shard, token))
+                        await sm.enqueue(task)
+                elif message[0] == "stopped":
+                    self.running -= 1
+
+    def report(self, shard, token, future):
+        if future.cancelled():
+            error = "Task cancelled"
+        else:
+            error = future.exception()
+            error = None if error is None else f"{type(error).__name__}: {error}"
+        self.inboxes[shard].put(("done", token, error))
+
+
+# --- WORKER PROCESSES ---
+
+def worker_main(shard, shards, inbox, outbox):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches every process, the front one stops the workers in order
+    asyncio.run(run_worker(shard, shards, inbox, outbox))
+
+
+async def run_worker(shard, shards, inbox, outbox):
+    sm.task_queue = durable_queue.MemoryQueue()  # The front process keeps the tasks it receives in its own queue
+    ring = HashRing(shards)
+    sm.timers.owns = lambda user_id: ring.shard(user_id) == shard
+    await sm.start_state_machine()
+    waiting = {}  # token -> future of a task executed by the front process
+    forwarder = asyncio.create_task(forward_tasks(shard, outbox, waiting))
+    # Steps go through their own task: submit_step waits while a mailbox is full, and the done messages that let that
+    # user's step finish must still be read meanwhile
+    steps = asyncio.Queue()
+    submitter = asyncio.create_task(submit_steps(steps))
+    stopping = None
+
+    while not (stopping and stopping.done()):
+        for message in await asyncio.to_thread(receive, inbox):
+            if message is None:
+                stopping = asyncio.create_task(drain(steps))
+            elif message[0] == "step":
+                steps.put_nowait((message[1], message[2]))
+            elif message[0] == "done":
+                future = waiting.pop(message[1], None)
+                if future and not future.done():
+                    if message[2] is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(RuntimeError(message[2]))
+
+    forwarder.cancel()
+    submitter.cancel()
+    await sm.stop_state_machine()
+    outbox.put(("stopped", shard))
+
+
+async def submit_steps(steps):
+    while True:
+        data, state = await steps.get()
+        try:
+            await sm.submit_step(data, state)
+        except Exception as e:
+            print(f"Error submitting step for user {data.get('id')}: {e}")
+        finally:
+            steps.task_done()
+
+
+async def drain(steps):
+    # Until the steps that were already received ran and their tasks were sent. Done messages are still read meanwhile
+    await steps.join()
+    await sm.drain_state_machine()
+    await sm.task_queue.join()
+
+
+async def forward_tasks(shard, outbox, waiting):
+    tokens = itertools.count()
+    while True:
+        batch = [await sm.task_queue.get()]
+        while len(batch) < SHARD_BATCH and not sm.task_queue.empty():
+            batch.append(sm.task_queue.get_nowait())
+
+        items = []
+        for task in batch:
+            token = None
+            if task.done is not None:  # Futures stay here, the front process answers with the token
+                token = next(tokens)
+                waiting[token] = task.done
+                task.done = None
+            items.append((token, task))
+        outbox.put(("tasks", shard, items))
+
+        for _ in batch:
+            sm.task_queue.task_done()
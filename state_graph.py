@@ -0,0 +1,204 @@
+'''
+Declarative state graph. Instead of writing a transition_protocol with an if-chain, a state lists where each message
+or callback goes and the table is compiled once when the graph is installed:
+
+    graph = StateGraph()
+    graph.state("START", core=start_core, default="MAIN")
+    graph.state("MAIN", messages={"Hola": "MAIN", "Menu": "MENU"}, patterns={r"\\d+": "NUMBER"},
+                callbacks={"back": "START"}, prefixes={"item:": "ITEM"}, transition=main_transition)
+    await graph.install()
+
+The same graph can be written in JSON or YAML and loaded with load(path), protocols are given by name:
+
+    {"states": {"MAIN": {"entry": "main_entry", "messages": {"Hola": "MAIN"}, "transition": "main_transition"}}}
+
+Lookups run in this order: exact message, message patterns (one combined regex), exact callback, longest callback
+prefix (trie), then transition as a fallback, then default. If nothing matches the user stays in the state.
+install() refuses a graph with a target that is not a state, instead of failing when a user reaches it.
+'''
+import re
+import json
+import inspect
+import importlib
+
+import executors
+import state_machine as sm
+from callbacks import PrefixTrie
+
+
+def scoped(pattern):
+    # Flags apply to the whole regex, inside the combined one they must be scoped to the group: (?i)hola -> (?i:hola)
+    if isinstance(pattern, re.Pattern):
+        flags = "".join(letter for letter, flag in (("i", re.IGNORECASE), ("m", re.MULTILINE), ("s", re.DOTALL), ("x", re.VERBOSE)) if pattern.flags & flag)
+        return f"(?{flags}:{pattern.pattern})" if flags else pattern.pattern
+    leading = re.match(r"\(\?([imsx]+)\)", pattern)
+    if leading:
+        return f"(?{leading[1]}:{pattern[leading.end():]})"
+    return pattern
+
+
+def combine(patterns):
+    '''
+    Compiles {pattern: target} into one regex with a named group per pattern, so a message is matched once.
+    Returns (regex, [target, ...]) or (None, []). Patterns are searched, anchor them with ^ and $ to match whole messages.
+    '''
+    if not patterns:
+        return None, []
+    targets = list(patterns.values())
+    return re.compile("|".join(f"(?P<_{index}>{scoped(pattern)})" for index, pattern in enumerate(patterns))), targets
+
+
+class StateSpec:
+    def __init__(self, name, entry=None, core=None, transition=None, messages=None, patterns=None, callbacks=None, prefixes=None, default=None, keyboards=None, blocking=None, timeout=None, idle_timeout=None, idle_state=None):
+        self.name = name
+        self.entry = entry
+        self.core = core
+        self.transition = transition
+        self.messages = dict(messages or {})
+        self.patterns = dict(patterns or {})
+        self.callbacks = dict(callbacks or {})
+        self.prefixes = dict(prefixes or {})
+        self.default = default
+        self.keyboards = keyboards
+        self.blocking = blocking
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.idle_state = idle_state
+
+    def targets(self):
+        targets = [*self.messages.values(), *self.patterns.values(), *self.callbacks.values(), *self.prefixes.values()]
+        if self.default:
+            targets.append(self.default)
+        if self.idle_state:
+            targets.append(self.idle_state)
+        return targets
+
+    def has_table(self):
+        return bool(self.messages or self.patterns or self.callbacks or self.prefixes or self.default)
+
+    def compile(self):
+        '''
+        Returns the transition_protocol of the state: the lookup tables with the transition as fallback.
+        '''
+        if not self.has_table():
+            return self.transition
+
+        name = self.name
+        messages = self.messages
+        callbacks = self.callbacks
+        regex, pattern_targets = combine(self.patterns)
+        trie = PrefixTrie(self.prefixes) if self.prefixes else None
+        fallback = self.transition
+        blocking = self.blocking and fallback and not inspect.iscoroutinefunction(fallback)
+        default = self.default or name
+
+        async def transition(data):
+            message = data.get("message")
+            if message is not None:
+                target = messages.get(message)
+                if target:
+                    return target
+                if regex:
+                    match = regex.search(message)
+                    if match:
+                        return pattern_targets[int(match.lastgroup[1:])]
+
+            callback_data = data.get("callback_data")
+            if callback_data is not None:
+                target = callbacks.get(callback_data)
+                if target is None and trie:
+                    target = trie.longest(callback_data)
+                if target:
+                    return target
+
+            if fallback:
+                if blocking:  # A plain function in a blocking state runs in its pool, like the other protocols
+                    return await executors.run(self.blocking, fallback, data, timeout=self.timeout)
+                return await fallback(data)
+            return default
+
+        return transition
+
+
+class StateGraph:
+    def __init__(self):
+        self.states = {}  # name -> StateSpec
+
+    def state(self, name, entry=None, core=None, transition=None, messages=None, patterns=None, callbacks=None, prefixes=None, default=None, keyboards=None, blocking=None, timeout=None, idle_timeout=None, idle_state=None):
+        '''
+        Declares a state. messages and callbacks map exact texts / callback_data to the next state, patterns map regexes of
+        the message and prefixes map beginnings of the callback_data. transition is called when none of them matches, and
+        default is the next state if there is no transition. The rest is as in sm.add_state. Returns the graph, to chain calls.
+        '''
+        if name in self.states:
+            raise ValueError(f"State {name} is declared twice")
+        self.states[name] = StateSpec(name, entry, core, transition, messages, patterns, callbacks, prefixes, default, keyboards, blocking, timeout, idle_timeout, idle_state)
+        return self
+
+    def validate(self, known=()):
+        '''
+        Raises ValueError if a transition goes to a state that is neither in the graph nor in known, or if a pattern is not a valid regex.
+        '''
+        names = set(self.states) | set(known)
+        missing = sorted({f"{spec.name} -> {target}" for spec in self.states.values() for target in spec.targets() if target not in names})
+        if missing:
+            raise ValueError(f"Transitions to states that don't exist: {', '.join(missing)}")
+        for spec in self.states.values():
+            try:
+                combine(spec.patterns)
+            except re.error as e:
+                raise ValueError(f"Invalid pattern in state {spec.name}: {e}") from None
+
+    async def install(self):
+        '''
+        Validates the graph against itself and the states already added, compiles the tables and adds every state with sm.add_state.
+        '''
+        self.validate(sm.states)
+        for spec in self.states.values():
+            await sm.add_state(spec.name, spec.entry, spec.core, spec.compile(), spec.keyboards, spec.blocking, spec.timeout, spec.idle_timeout, spec.idle_state)
+
+    @classmethod
+    def from_dict(cls, definition, namespace=None):
+        '''
+        Builds a graph from {"states": {name: {...}}} where entry, core and transition are names. A name is looked up in
+        namespace (the state_machine module by default) or imported if it is written as "module:function".
+        '''
+        namespace = vars(sm) if namespace is None else namespace
+        graph = cls()
+        for name, options in definition.get("states", {}).items():
+            options = dict(options or {})
+            for protocol in ("entry", "core", "transition"):
+                if options.get(protocol):
+                    options[protocol] = resolve(options[protocol], namespace)
+            try:
+                graph.state(name, **options)
+            except TypeError as e:
+                raise ValueError(f"Invalid definition of state {name}: {e}") from None
+        return graph
+
+
+def resolve(reference, namespace):
+    if callable(reference):
+        return reference
+    if ":" in reference:
+        module, attribute = reference.split(":", 1)
+        return getattr(importlib.import_module(module), attribute)
+    if reference not in namespace:
+        raise ValueError(f"Protocol {reference} not found")
+    return namespace[reference]
+
+
+def load(path, namespace=None):
+    '''
+    Reads a graph from a .json, .yaml or .yml file. YAML needs PyYAML installed.
+    '''
+    with open(path, encoding="utf-8") as file:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("Loading a state graph from YAML needs PyYAML: pip install pyyaml") from None
+            definition = yaml.safe_load(file)
+        else:
+            definition = json.load(file)
+    return StateGraph.from_dict(definition or {}, namespace)
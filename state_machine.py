@@ -1,104 +1,232 @@
+import time
 import asyncio
+import inspect
+import contextvars
+import dataclasses
+from collections import deque
+import tasks
+import storage
+import metrics
+import executors
+import durable_queue
+from markup import freeze
+from message_registry import MessageRegistry
+from callbacks import CallbackStore
+from retry import BlockedUsers, DeadLetters
+from timers import TimerWheel
+from ingest import Ingest
 
 states = {}
-task_queue = asyncio.Queue()
-user_state = {}
-user_vault = {}
-
-async def add_task(user_id, task, data={}):
-    await task_queue.put((user_id, task, data))
-
-async def send_message(user_id, text, parse_mode=None, disable_web_page_preview=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, keyboard=None, inline_keyboard=None, save=None):
-    await add_task(user_id, "message", {
-        "text": text,
-        "parse_mode": parse_mode,
-        "disable_web_page_preview": disable_web_page_preview,
-        "disable_notification": disable_notification,
-        "protect_content": protect_content,
-        "reply_to_message_id": reply_to_message_id,
-        "allow_sending_without_reply": allow_sending_without_reply,
-        "keyboard": keyboard,
-        "inline_keyboard": inline_keyboard,
-        "save": save
-    })
-
-async def edit_message(user_id, message_id, text, parse_mode=None, disable_web_page_preview=None, disable_notification=None, protect_content=None, keyboard=None, inline_keyboard=None, save=None):
-    await add_task(user_id, "editmessage", {
-        "message_id": message_id,
-        "text": text,
-        "parse_mode": parse_mode,
-        "disable_web_page_preview": disable_web_page_preview,
-        "disable_notification": disable_notification,
-        "protect_content": protect_content,
-        "keyboard": keyboard,
-        "inline_keyboard": inline_keyboard,
-        "save": save
-    })
-
-async def delete_message(user_id, message_id):
-    await add_task(user_id, "delete", {
-        "message_id": message_id
-    })
-
-async def send_photo(user_id, photo, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, keyboard=None, inline_keyboard=None, save=None):
-    await add_task(user_id, "photo", {
-        "photo": photo,
-        "caption": caption,
-        "parse_mode": parse_mode,
-        "disable_notification": disable_notification,
-        "protect_content": protect_content,
-        "reply_to_message_id": reply_to_message_id,
-        "allow_sending_without_reply": allow_sending_without_reply,
-        "keyboard": keyboard,
-        "inline_keyboard": inline_keyboard,
-        "save": save
-    })
-
-async def send_document(user_id, document, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, keyboard=None, inline_keyboard=None, save=None):
-    await add_task(user_id, "document", {
-        "document": document,
-        "caption": caption,
-        "parse_mode": parse_mode,
-        "disable_notification": disable_notification,
-        "protect_content": protect_content,
-        "reply_to_message_id": reply_to_message_id,
-        "allow_sending_without_reply": allow_sending_without_reply,
-        "keyboard": keyboard,
-        "inline_keyboard": inline_keyboard,
-        "save": save
-    })
-
-async def send_video(user_id, video, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, keyboard=None, inline_keyboard=None, save=None):
-    await add_task(user_id, "video", {
-        "video": video,
-        "caption": caption,
-        "parse_mode": parse_mode,
-        "disable_notification": disable_notification,
-        "protect_content": protect_content,
-        "reply_to_message_id": reply_to_message_id,
-        "allow_sending_without_reply": allow_sending_without_reply,
-        "keyboard": keyboard,
-        "inline_keyboard": inline_keyboard,
-        "save": save
-    })
-
-async def send_poll(user_id, question, options, type="regular", correct_option_id=None, is_anonymous=False, open_period=None, allow_multiple_answers=None, explanation=None, explanation_parse_mode=None, reply_to_message_id=None, allow_sending_without_reply=None, keyboard=None, inline_keyboard=None, save=None):
-    await add_task(user_id, "poll", {
-        "question": question,
-        "options": options,
-        "type": type,
-        "correct_option_id": correct_option_id,
-        "is_anonymous": is_anonymous,
-        "open_period": open_period,
-        "allow_multiple_answers": allow_multiple_answers,
-        "explanation": explanation,
-        "explanation_parse_mode": explanation_parse_mode,
-        "reply_to_message_id": reply_to_message_id,
-        "allow_sending_without_reply": allow_sending_without_reply,
-        "keyboard": keyboard,
-        "inline_keyboard": inline_keyboard,
-        "save": save
-    })
+named_keyboards = {} # Keyboard layouts declared with add_state, they can be passed by name as keyboard or inline_keyboard
+task_queue = durable_queue.open_queue() # In memory, or also on disk with TASK_QUEUE=sqlite in the .env
+store = storage.UserStore(storage.open_backend()) # Backend is chosen with STORAGE / STORAGE_PATH in the .env
+user_state = store.view(0)
+user_vault = store.view(1)
+saved_messages = MessageRegistry(None if isinstance(store.backend, storage.MemoryBackend) else store.backend) # Ids of the messages sent with save="name", per user
+callback_store = CallbackStore(saved_messages.backend) # Callback data of the buttons with structured payloads that don't fit in 64 bytes
+blocked_users = BlockedUsers(saved_messages.backend) # Users that blocked the bot, nothing is sent to them until they write again
+dead_letters = DeadLetters(saved_messages.backend) # Tasks that failed for good, dead_letters.replay(enqueue) sends them again
+timers = TimerWheel(saved_messages.backend) # Tasks scheduled for later and the idle timeouts of the states
+idle_timeouts = False # True once a state has an idle_timeout, until then steps don't touch the timers
+updates = Ingest() # The handlers submit through it, it drops repeated updates and merges albums before submit_step
+mailboxes = {} # user_id -> Mailbox with the steps waiting for that user
+actors = set() # Running user actors, kept here so they are not garbage collected
+downloads = None # downloads.DownloadService of the engine, protocols fetch the media users send with it
+step_router = None # When set, submit_step hands the steps to it instead of running them here (sharding.ShardedRunner does it)
+
+reply_priority = contextvars.ContextVar("reply_priority", default=tasks.NORMAL) # Priority of the tasks enqueued without one, interactive during a step
+
+MAILBOX_SIZE = 100 # Steps a user can have waiting before the handlers have to wait for room
+BROADCAST_WINDOW = 1000 # Tasks of a broadcast that can be in the queue at the same time
+BROADCAST_CHECKPOINT = 100 # A broadcast saves its progress every this many recipients
+
+async def enqueue(task):
+    if task.priority is None:
+        task.priority = reply_priority.get()
+    elif task.priority not in tasks.PRIORITIES:
+        raise ValueError(f"Unknown priority: {task.priority}")
+    task.enqueued_at = time.perf_counter()
+    await task_queue.put(task)
+
+async def add_task(user_id, task, data={}, done=None):
+    # Old style: the name of the action and a dict with its params. done is an optional future that the dispatcher resolves once the task was executed (or sets the error if it failed)
+    await enqueue(tasks.from_action(user_id, task, data, done))
+
+async def send_message(user_id, text, parse_mode=None, disable_web_page_preview=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, keyboard=None, inline_keyboard=None, save=None, priority=None):
+    await enqueue(tasks.MessageTask(
+        user_id=user_id,
+        text=text,
+        parse_mode=parse_mode,
+        disable_web_page_preview=disable_web_page_preview,
+        disable_notification=disable_notification,
+        protect_content=protect_content,
+        reply_to_message_id=reply_to_message_id,
+        allow_sending_without_reply=allow_sending_without_reply,
+        keyboard=keyboard,
+        inline_keyboard=inline_keyboard,
+        save=save,
+        priority=priority
+    ))
+
+async def edit_message(user_id, message_id, text, parse_mode=None, disable_web_page_preview=None, disable_notification=None, protect_content=None, keyboard=None, inline_keyboard=None, save=None, priority=None):
+    await enqueue(tasks.EditMessageTask(
+        user_id=user_id,
+        message_id=message_id,
+        text=text,
+        parse_mode=parse_mode,
+        disable_web_page_preview=disable_web_page_preview,
+        disable_notification=disable_notification,
+        protect_content=protect_content,
+        keyboard=keyboard,
+        inline_keyboard=inline_keyboard,
+        save=save,
+        priority=priority
+    ))
+
+async def delete_message(user_id, message_id, priority=None):
+    await enqueue(tasks.DeleteTask(
+        user_id=user_id,
+        message_id=message_id,
+        priority=priority
+    ))
+
+async def send_photo(user_id, photo, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, keyboard=None, inline_keyboard=None, save=None, priority=None):
+    await enqueue(tasks.PhotoTask(
+        user_id=user_id,
+        photo=photo,
+        caption=caption,
+        parse_mode=parse_mode,
+        disable_notification=disable_notification,
+        protect_content=protect_content,
+        reply_to_message_id=reply_to_message_id,
+        allow_sending_without_reply=allow_sending_without_reply,
+        keyboard=keyboard,
+        inline_keyboard=inline_keyboard,
+        save=save,
+        priority=priority
+    ))
+
+async def send_document(user_id, document, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, keyboard=None, inline_keyboard=None, save=None, priority=None):
+    await enqueue(tasks.DocumentTask(
+        user_id=user_id,
+        document=document,
+        caption=caption,
+        parse_mode=parse_mode,
+        disable_notification=disable_notification,
+        protect_content=protect_content,
+        reply_to_message_id=reply_to_message_id,
+        allow_sending_without_reply=allow_sending_without_reply,
+        keyboard=keyboard,
+        inline_keyboard=inline_keyboard,
+        save=save,
+        priority=priority
+    ))
+
+async def send_video(user_id, video, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, keyboard=None, inline_keyboard=None, save=None, priority=None):
+    await enqueue(tasks.VideoTask(
+        user_id=user_id,
+        video=video,
+        caption=caption,
+        parse_mode=parse_mode,
+        disable_notification=disable_notification,
+        protect_content=protect_content,
+        reply_to_message_id=reply_to_message_id,
+        allow_sending_without_reply=allow_sending_without_reply,
+        keyboard=keyboard,
+        inline_keyboard=inline_keyboard,
+        save=save,
+        priority=priority
+    ))
+
+async def send_poll(user_id, question, options, type="regular", correct_option_id=None, is_anonymous=False, open_period=None, allow_multiple_answers=None, explanation=None, explanation_parse_mode=None, reply_to_message_id=None, allow_sending_without_reply=None, keyboard=None, inline_keyboard=None, save=None, priority=None):
+    await enqueue(tasks.PollTask(
+        user_id=user_id,
+        question=question,
+        options=options,
+        type=type,
+        correct_option_id=correct_option_id,
+        is_anonymous=is_anonymous,
+        open_period=open_period,
+        allow_multiple_answers=allow_multiple_answers,
+        explanation=explanation,
+        explanation_parse_mode=explanation_parse_mode,
+        reply_to_message_id=reply_to_message_id,
+        allow_sending_without_reply=allow_sending_without_reply,
+        keyboard=keyboard,
+        inline_keyboard=inline_keyboard,
+        save=save,
+        priority=priority
+    ))
+
+async def schedule(user_id, delay, task, timer_id=None):
+    # Enqueues task (a tasks.Task) in delay seconds, even after a restart if the storage is sqlite. Returns the timer id,
+    # scheduling again with the same timer_id replaces that timer
+    return timers.schedule(user_id, delay, task, timer_id)
+
+async def cancel_timer(timer_id):
+    # Returns True if the timer was still pending
+    return timers.cancel(timer_id)
+
+async def broadcast(user_ids, payload, action="message", name=None, priority=tasks.BULK):
+    '''
+    Sends the same task to many users. user_ids can be any iterable or async iterable and is consumed lazily. payload is a
+    task (like tasks.MessageTask(user_id=None, text="Hi")) or the params of action as a dict, and every recipient shares its values.
+    The tasks go in the bulk lane unless another priority is given, so replies to users are not stuck behind them.
+    At most BROADCAST_WINDOW tasks are in the queue at once. If a name is given the progress is checkpointed, so calling
+    broadcast again with the same name and recipients after a crash resumes where it stopped. A name identifies one run:
+    the checkpoint is deleted once it finishes, so a later broadcast with the same name (a daily "news") starts over.
+    Returns a report with the sent and failed counts and the throughput.
+    '''
+    report = {"sent": 0, "failed": 0}
+    if name:
+        report.update(await asyncio.to_thread(store.backend.load_value, "broadcasts", name) or {})
+    position = report["sent"] + report["failed"] # Recipients already done in a previous run
+    start = time.perf_counter()
+    window = deque()
+    index = 0
+    template = payload if isinstance(payload, tasks.Task) else tasks.from_action(None, action, payload)
+    template = dataclasses.replace(template, priority=template.priority or priority)
+
+    async def wait_oldest():
+        try:
+            await window.popleft()
+            report["sent"] += 1
+        except Exception:
+            report["failed"] += 1
+        if name and (report["sent"] + report["failed"]) % BROADCAST_CHECKPOINT == 0:
+            await save_checkpoint()
+
+    async def save_checkpoint():
+        await asyncio.to_thread(store.backend.save_values, "broadcasts", [(name, dict(report), None)])
+
+    async for user_id in iterate(user_ids):
+        index += 1
+        if index <= position:
+            continue
+        if len(window) >= BROADCAST_WINDOW:
+            await wait_oldest()
+        done = asyncio.get_running_loop().create_future()
+        await enqueue(dataclasses.replace(template, user_id=user_id, done=done))
+        window.append(done)
+
+    while window:
+        await wait_oldest()
+    if name:
+        await asyncio.to_thread(store.backend.save_values, "broadcasts", [(name, None, None)]) # Finished, nothing to resume
+
+    elapsed = time.perf_counter() - start
+    report["elapsed"] = elapsed
+    report["rate"] = (report["sent"] + report["failed"] - position) / elapsed if elapsed else 0.0 # Tasks per second in this run
+    print(f"Broadcast {name or ''} finished: {report['sent']} sent, {report['failed']} failed, {report['rate']:.1f} msg/s")
+    return report
+
+async def iterate(items):
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
 
 async def set_user_state(user_id, state):
     user_state[user_id] = state
@@ -108,52 +236,196 @@ class State:
     entry_protocol = None
     core_protocol = None
     transition_protocol = None
+    keyboards = None
+    timings = None
+    blocking = None
+    timeout = None
+    idle_timeout = None
+    idle_state = None
 
-    def __init__(self, entry_protocol=None, core_protocol=None, transition_protocol=None):
+    def __init__(self, name, entry_protocol=None, core_protocol=None, transition_protocol=None, keyboards=None, blocking=None, timeout=None, idle_timeout=None, idle_state=None):
         self.entry_protocol = entry_protocol
         self.core_protocol = core_protocol
         self.transition_protocol = transition_protocol
+        self.keyboards = keyboards or {}
+        self.blocking = blocking
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.idle_state = idle_state
+        # How long each protocol takes, the histograms are looked up once here instead of on every step
+        self.timings = {protocol: metrics.histogram("state_protocol_seconds", "Time spent in each protocol of each state", state=name, protocol=protocol) for protocol in ("entry", "core", "transition")}
+
+    async def call(self, protocol, data):
+        # Plain functions of a blocking state run in its pool, coroutines always run on the loop
+        if self.blocking and not inspect.iscoroutinefunction(protocol):
+            return await executors.run(self.blocking, protocol, data, timeout=self.timeout)
+        return await protocol(data)
 
-async def add_state(name, entry_protocol=None, core_protocol=None, transition_protocol=None):
-    states[name] = State(entry_protocol, core_protocol, transition_protocol)
+async def add_state(name, entry_protocol=None, core_protocol=None, transition_protocol=None, keyboards=None, blocking=None, timeout=None, idle_timeout=None, idle_state=None):
+    # keyboards is a dict of name -> layout, for example {"main_menu": [["Option 1", "Option 2"]]}. Then send_message(..., keyboard="main_menu")
+    # blocking="thread" or "process" lets the protocols of the state be plain (def) functions that block, they run in that pool
+    # instead of the event loop. They can't await, so a blocking core returns its result, which is put in data["core_result"]
+    # for the transition, and a blocking transition returns the next state as usual. With "process" they get a copy of data,
+    # so changing it has no effect, and they must be defined at module level. timeout is in seconds (BLOCKING_TIMEOUT by default)
+    # idle_timeout moves a user that stays idle_timeout seconds in the state without sending anything to idle_state, running
+    # its entry protocol with data = {"id": user_id, "idle": name}
+    global idle_timeouts
+    if blocking not in (None, *executors.KINDS):
+        raise ValueError(f"Unknown blocking kind: {blocking}. Use one of: {', '.join(executors.KINDS)}")
+    if idle_timeout and not idle_state:
+        raise ValueError(f"State {name} has an idle_timeout but no idle_state")
+    layouts = {keyboard_name: freeze(layout) for keyboard_name, layout in (keyboards or {}).items()}
+    for keyboard_name, layout in layouts.items():
+        if named_keyboards.get(keyboard_name, layout) != layout:
+            raise ValueError(f"Keyboard {keyboard_name} is declared with different layouts")
+    named_keyboards.update(layouts)
+    states[name] = State(name, entry_protocol, core_protocol, transition_protocol, layouts, blocking, timeout, idle_timeout, idle_state)
+    idle_timeouts = idle_timeouts or bool(idle_timeout)
     
+def get_state(name):
+    state = states.get(name)
+    if state is None:
+        raise ValueError(f"Unknown state: {name}") # The user stays in the state it was in
+    return state
+
 async def run_state(state_name, data):
-    state = states.get(state_name)
+    state = get_state(state_name)
 
     if state.core_protocol:
-        await state.core_protocol(data)
+        start = time.perf_counter()
+        result = await state.call(state.core_protocol, data)
+        if result is not None:
+            data["core_result"] = result
+        state.timings["core"].observe(time.perf_counter() - start)
         
     if state.transition_protocol:
-        next_state_name = await state.transition_protocol(data)
+        start = time.perf_counter()
+        next_state_name = await state.call(state.transition_protocol, data)
+        state.timings["transition"].observe(time.perf_counter() - start)
     else:
         next_state_name = state_name
 
-    state = states.get(next_state_name)
-    if state.entry_protocol:
-        await state.entry_protocol(data)
-    
+    await run_entry(next_state_name, data)
     return next_state_name
 
+async def run_entry(state_name, data):
+    state = get_state(state_name)
+    if state.entry_protocol:
+        start = time.perf_counter()
+        await state.call(state.entry_protocol, data)
+        state.timings["entry"].observe(time.perf_counter() - start)
+
+def arm_idle_timer(user_id, state_name):
+    # One idle timer per user, every step replaces it with the one of the state the user is in now (or removes it)
+    key = f"idle:{user_id}"
+    state = states.get(state_name)
+    if state and state.idle_timeout:
+        timers.schedule(user_id, state.idle_timeout, tasks.RunTask(user_id=user_id, data={"id": user_id, "idle": state_name}), key)
+    else:
+        timers.cancel(key)
+
 
 
 #region State Machine Setup
 async def start_state_machine():
+    # States can also be declared as a graph with lookup tables for their transitions, see state_graph.py
     #          State Name   Entry Function   Core Function   Transition Function
     await add_state("START", None, start_core, start_transition)
     await add_state("MAIN", main_entry, None, main_transition)
     
+    await blocked_users.load()
+    await dead_letters.load()
+    await timers.start(enqueue)
+    await updates.start(submit_step, blocked_users)
+    store.start()
+    saved_messages.start()
+    callback_store.start()
+
     # Here you can add functions that run in the background to check for something or update something IDK
+    # For things that happen later for a user (reminders, timeouts), use schedule() instead of a sleeping task per user
     #asyncio.create_task(background_function())
 
-async def run_state_machine_step(data: dict) -> list:
+async def drain_state_machine():
+    # Call it before engine.stop(): sends the held updates and lets the steps already received run, so their replies still go out
+    await updates.stop()
+    await timers.stop()
+    while actors:
+        await asyncio.gather(*actors, return_exceptions=True)
+
+async def stop_state_machine():
+    # After engine.stop(): writes the users and saved messages that changed since the last flush
+    await timers.stop()
+    await saved_messages.stop()
+    await callback_store.stop()
+    await store.stop()
+    executors.shutdown()
+
+class Mailbox:
+    def __init__(self, maxsize):
+        self.queue = asyncio.Queue(maxsize)
+        self.waiting = 0 # Handlers that are putting a step in, the actor must not leave while there are any
+
+async def submit_step(data: dict, state=None) -> None:
+    '''
+    Puts a step in the user's mailbox and returns. Steps of one user run one after the other, steps of different users run concurrently.
+    If state is given the user is moved to that state right before the step runs. If the mailbox is full this waits until there is room.
+    '''
+    user_id = data.get("id")
+    if step_router:
+        return await step_router(data, state)
+
+    mailbox = mailboxes.get(user_id)
+    if mailbox is None:
+        mailbox = mailboxes[user_id] = Mailbox(MAILBOX_SIZE)
+        actor = asyncio.create_task(user_actor(user_id, mailbox))
+        actors.add(actor)
+        actor.add_done_callback(actors.discard)
+
+    mailbox.waiting += 1
+    try:
+        await mailbox.queue.put((data, state))
+    finally:
+        mailbox.waiting -= 1
+
+async def user_actor(user_id, mailbox):
+    # Lives while the user has steps waiting, so idle users cost nothing
+    while True:
+        if mailbox.queue.empty() and not mailbox.waiting:
+            del mailboxes[user_id]
+            return
+        data, state = await mailbox.queue.get()
+        try:
+            await run_state_machine_step(data, state)
+        except Exception as e:
+            print(f"Error in state machine step for user {user_id}: {e}")
+
+async def run_state_machine_step(data: dict, state=None) -> list:
     user_id = data.get("id")
-    if user_id not in user_state: #Safeguard if the user is not in the state dict, which should never happen but just in case
-        user_state[user_id] = "START"
-        user_vault[user_id] = {}
+    await store.checkout(user_id) # Loads the user without blocking and keeps it in memory during the step
+    replying = reply_priority.set(tasks.INTERACTIVE) # What the step sends answers the user, it goes before other traffic
+    try:
+        if user_id not in user_state: #Safeguard if the user is not in the state dict, which should never happen but just in case
+            user_state[user_id] = "START"
+            user_vault[user_id] = {}
+        if state:
+            user_state[user_id] = state
 
-    state = user_state[user_id]
-    next_state = await run_state(state, data)
-    user_state[user_id] = next_state
+        state = user_state[user_id]
+        idle = data.get("idle")
+        if idle is not None:
+            # The idle timeout of a state. Stale if the user left it, or did something since and the timer was armed again
+            if idle != state or f"idle:{user_id}" in timers:
+                return
+            next_state = get_state(state).idle_state
+            await run_entry(next_state, data)
+        else:
+            next_state = await run_state(state, data)
+        user_state[user_id] = next_state
+        if idle_timeouts:
+            arm_idle_timer(user_id, next_state)
+    finally:
+        reply_priority.reset(replying)
+        store.release(user_id)
 
 
 
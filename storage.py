@@ -0,0 +1,341 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+STORAGE = os.getenv("STORAGE", "memory")  # "memory" or "sqlite"
+STORAGE_PATH = os.getenv("STORAGE_PATH", "bot.db")
+CACHE_SIZE = int(os.getenv("STORAGE_CACHE_SIZE", "10000"))  # Users kept in memory
+FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_MS", "500")) / 1000
+FLUSH_CHANGES = int(os.getenv("STORAGE_FLUSH_CHANGES", "500"))
+
+
+# --- BACKENDS ---
+# A backend loads one user and saves many users at once, both from a worker thread.
+# prepare runs on the event loop before save_users, so the vaults are serialized while nobody else is touching them.
+# Besides users a backend keeps namespaced values (JSON types only) with an optional expiry time, for the other modules that need to persist something.
+
+class MemoryBackend:
+    def __init__(self):
+        self.users = {}
+        self.values = {}  # namespace -> {key: (value, expires)}
+
+    def load_user(self, user_id):
+        return self.users.get(user_id)
+
+    def prepare(self, records):
+        return records
+
+    def save_users(self, records):
+        for user_id, state, vault in records:
+            self.users[user_id] = (state, vault)
+
+    def load_value(self, namespace, key):
+        value, expires = self.values.get(namespace, {}).get(key, (None, None))
+        if expires is not None and expires <= time.time():
+            return None
+        return value
+
+    def load_values(self, namespace):
+        now = time.time()
+        return {key: value for key, (value, expires) in self.values.get(namespace, {}).items() if expires is None or expires > now}
+
+    def save_values(self, namespace, items):
+        values = self.values.setdefault(namespace, {})
+        for key, value, expires in items:  # A value of None deletes the key
+            if value is None:
+                values.pop(key, None)
+            else:
+                values[key] = (value, expires)
+
+    def prune_values(self, now):
+        for values in self.values.values():
+            for key in [key for key, (value, expires) in values.items() if expires is not None and expires <= now]:
+                del values[key]
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend:
+    '''
+    Keeps users in a SQLite file in WAL mode. The vault is stored as JSON, so it must only hold JSON types.
+    '''
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")  # With WAL this only syncs on checkpoints, not on every commit
+        self.connection.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, state TEXT, vault TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS kv (namespace TEXT, key TEXT, value TEXT, expires REAL, PRIMARY KEY (namespace, key))")
+        self.connection.commit()
+
+    def load_user(self, user_id):
+        with self.lock:
+            row = self.connection.execute("SELECT state, vault FROM users WHERE user_id = ?", (json.dumps(user_id),)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def prepare(self, records):
+        return [(json.dumps(user_id), state, json.dumps(vault)) for user_id, state, vault in records]
+
+    def save_users(self, rows):
+        with self.lock, self.connection:  # One transaction for the whole batch
+            self.connection.executemany("INSERT OR REPLACE INTO users (user_id, state, vault) VALUES (?, ?, ?)", rows)
+
+    def load_value(self, namespace, key):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM kv WHERE namespace = ? AND key = ? AND (expires IS NULL OR expires > ?)", (namespace, key, time.time())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def load_values(self, namespace):
+        with self.lock:
+            rows = self.connection.execute("SELECT key, value FROM kv WHERE namespace = ? AND (expires IS NULL OR expires > ?)", (namespace, time.time())).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def save_values(self, namespace, items):
+        saved = [(namespace, key, json.dumps(value), expires) for key, value, expires in items if value is not None]
+        deleted = [(namespace, key) for key, value, expires in items if value is None]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO kv (namespace, key, value, expires) VALUES (?, ?, ?, ?)", saved)
+            self.connection.executemany("DELETE FROM kv WHERE namespace = ? AND key = ?", deleted)
+
+    def prune_values(self, now):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM kv WHERE expires IS NOT NULL AND expires <= ?", (now,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def open_backend(kind=STORAGE, path=STORAGE_PATH):
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "sqlite":
+        return SQLiteBackend(path)
+    raise ValueError(f"Unknown storage backend: {kind}")
+
+
+class WriteBehind:
+    '''
+    Values of one namespace of a backend, written in batches: put keeps the last value of each key until the next flush,
+    which saves them all in one call. Once started it flushes every flush_interval seconds, then runs every (an optional
+    async function) so its owner can do its own periodic work, and flushes once more on stop.
+    '''
+    def __init__(self, backend, namespace, flush_interval=FLUSH_INTERVAL, every=None):
+        self.backend = backend
+        self.namespace = namespace
+        self.flush_interval = flush_interval
+        self.every = every
+        self.unsaved = {}  # key -> (value, expires), a value of None deletes the key
+        self.flusher = None
+
+    def put(self, key, value, expires=None):
+        if self.backend:
+            self.unsaved[key] = (value, expires)
+
+    def discard(self, key):
+        self.unsaved.pop(key, None)
+
+    def get(self, key):
+        '''
+        Returns the value waiting to be written for key, or None.
+        '''
+        return self.unsaved.get(key, (None, None))[0]
+
+    async def flush(self):
+        if not self.unsaved or not self.backend:
+            return
+        unsaved, self.unsaved = self.unsaved, {}
+        try:
+            await asyncio.to_thread(self.backend.save_values, self.namespace, [(key, value, expires) for key, (value, expires) in unsaved.items()])
+        except Exception:
+            self.unsaved = {**unsaved, **self.unsaved}  # Try again on the next flush, newer values win
+            raise
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if self.every:
+                    await self.every()
+            except Exception as e:
+                print(f"Error saving {self.namespace}: {e}")
+
+    def start(self):
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.flusher:
+            self.flusher.cancel()
+            await asyncio.gather(self.flusher, return_exceptions=True)
+            self.flusher = None
+        await self.flush()
+
+
+# --- CACHE ---
+
+class UserStore:
+    '''
+    LRU cache of users in front of a backend. Changes are written behind: dirty users are saved together in one batch
+    every flush_interval seconds, or sooner once flush_changes users are dirty.
+    '''
+    def __init__(self, backend, cache_size=CACHE_SIZE, flush_interval=FLUSH_INTERVAL, flush_changes=FLUSH_CHANGES):
+        self.backend = backend
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.flush_changes = flush_changes
+        self.cache = OrderedDict()  # user_id -> [state, vault]
+        self.dirty = set()
+        self.writing = set()  # Users being saved right now, the backend may still have their previous record
+        self.missing = set()  # Checked out users the backend doesn't have, so they are not looked up again
+        self.pinned = {}  # user_id -> number of steps using it, those are never evicted
+        self.changed = asyncio.Event()
+        self.flusher = None
+
+    def get(self, user_id):
+        '''
+        Returns the user's [state, vault] record, loading it from the backend if needed, or None if the user doesn't exist.
+        '''
+        record = self.cache.get(user_id)
+        if record is not None:
+            self.cache.move_to_end(user_id)
+            return record
+        if user_id in self.missing:
+            return None
+        loaded = self.backend.load_user(user_id)
+        return None if loaded is None else self.remember(user_id, loaded)
+
+    async def checkout(self, user_id):
+        '''
+        Loads the user without blocking the loop and keeps it in memory until release is called.
+        '''
+        self.pinned[user_id] = self.pinned.get(user_id, 0) + 1
+        if user_id not in self.cache and user_id not in self.writing:
+            loaded = await asyncio.to_thread(self.backend.load_user, user_id)
+            if user_id not in self.cache:
+                if loaded is None:
+                    self.missing.add(user_id)  # A new user, creating it in the step doesn't read the backend on the loop
+                else:
+                    self.remember(user_id, loaded)
+
+    def release(self, user_id):
+        self.pinned[user_id] -= 1
+        if not self.pinned[user_id]:
+            del self.pinned[user_id]
+            self.missing.discard(user_id)
+        self.mark_dirty(user_id)  # The vault may have been changed in place
+
+    def remember(self, user_id, loaded):
+        record = self.cache[user_id] = [loaded[0], loaded[1]]
+        self.missing.discard(user_id)
+        self.evict(keep=user_id)  # Not yet dirty, the caller may be about to change it
+        return record
+
+    def set(self, user_id, field, value):
+        record = self.get(user_id)
+        if record is None:
+            record = self.remember(user_id, (None, {}))
+        record[field] = value
+        self.mark_dirty(user_id)
+
+    def mark_dirty(self, user_id):
+        if user_id in self.cache:
+            self.dirty.add(user_id)
+            if len(self.dirty) >= self.flush_changes:
+                self.changed.set()
+
+    def evict(self, keep=None):
+        # Dirty, pinned and being written users stay until they are flushed and released
+        for user_id in list(self.cache):
+            if len(self.cache) <= self.cache_size:
+                break
+            if user_id != keep and user_id not in self.dirty and user_id not in self.pinned and user_id not in self.writing:
+                del self.cache[user_id]
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        self.writing |= dirty
+        try:
+            records = []
+            for user_id in dirty:
+                # One by one, so a vault that can't be serialized doesn't keep the rest of the batch from being saved
+                try:
+                    records += self.backend.prepare([(user_id, self.cache[user_id][0], self.cache[user_id][1])])
+                except (TypeError, ValueError) as e:
+                    print(f"Not saving user {user_id}, its vault can't be stored: {e}")
+            await asyncio.to_thread(self.backend.save_users, records)
+        except Exception:
+            self.dirty |= dirty  # Try again on the next flush
+            raise
+        finally:
+            self.writing -= dirty
+        self.evict()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.changed.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.changed.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing user storage: {e}")
+
+    def start(self):
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.flusher:
+            self.flusher.cancel()
+            await asyncio.gather(self.flusher, return_exceptions=True)
+            self.flusher = None
+        await self.flush()
+        self.backend.close()
+
+    def view(self, field):
+        return StoreView(self, field)
+
+
+class StoreView(MutableMapping):
+    '''
+    Dict-like access to one field of every user (0 is the state, 1 is the vault), so sm.user_state[user_id] keeps working.
+    Iterating only goes over the users currently in memory.
+    '''
+    def __init__(self, store, field):
+        self.store = store
+        self.field = field
+
+    def __getitem__(self, user_id):
+        record = self.store.get(user_id)
+        if record is None:
+            raise KeyError(user_id)
+        return record[self.field]
+
+    def __setitem__(self, user_id, value):
+        self.store.set(user_id, self.field, value)
+
+    def __delitem__(self, user_id):
+        raise TypeError("Users can't be deleted through this view")
+
+    def __contains__(self, user_id):
+        return self.store.get(user_id) is not None
+
+    def __iter__(self):
+        return iter(list(self.store.cache))
+
+    def __len__(self):
+        return len(self.store.cache)
@@ -0,0 +1,151 @@
+'''
+Outgoing tasks. Each action is a slotted dataclass, the front-ends execute them with a dispatch table keyed by type.
+'''
+from __future__ import annotations
+
+from dataclasses import dataclass, field, fields
+from typing import Any
+
+# Lanes of the dispatcher, highest priority first. Replies to the user whose update is being handled are interactive,
+# other sends are normal unless told otherwise, broadcasts are bulk and RunTasks go in their own lane.
+INTERACTIVE = "interactive"
+NORMAL = "normal"
+RUN = "run"
+BULK = "bulk"
+PRIORITIES = (INTERACTIVE, NORMAL, RUN, BULK)
+
+
+@dataclass(slots=True, kw_only=True)
+class Task:
+    user_id: Any
+    done: Any = field(default=None, repr=False)  # Optional future, resolved by the dispatcher once the task was executed
+    enqueued_at: float = field(default=0.0, repr=False)  # perf_counter() when it was put in the queue
+    attempts: int = field(default=0, repr=False)  # Times it was retried after a transient error
+    priority: str | None = field(default=None, repr=False)  # One of PRIORITIES, None picks it when enqueued
+    queue_id: int | None = field(default=None, repr=False)  # Row of the task in a durable queue, if it is kept in one
+
+
+@dataclass(slots=True, kw_only=True)
+class MarkupTask(Task):
+    keyboard: Any = None  # Rows of captions, or the name of a keyboard declared with add_state
+    inline_keyboard: Any = None  # Rows of (caption, callback_data), or the name of a keyboard
+    remove_keyboard: bool = False
+    save: str | None = None  # Name to save the id of the sent message under
+
+
+@dataclass(slots=True, kw_only=True)
+class MessageTask(MarkupTask):
+    text: str
+    parse_mode: Any = None
+    disable_web_page_preview: bool | None = None
+    disable_notification: bool | None = None
+    protect_content: bool | None = None
+    reply_to_message_id: str | None = None  # Name of a saved message
+    allow_sending_without_reply: bool | None = None
+
+
+@dataclass(slots=True, kw_only=True)
+class EditMessageTask(MarkupTask):
+    message_id: str  # Name of a saved message
+    text: str
+    parse_mode: Any = None
+    disable_web_page_preview: bool | None = None
+    disable_notification: bool | None = None
+    protect_content: bool | None = None
+
+
+@dataclass(slots=True, kw_only=True)
+class DeleteTask(Task):
+    message_id: str  # Name of a saved message
+
+
+@dataclass(slots=True, kw_only=True)
+class MediaTask(MarkupTask):
+    caption: str | None = None
+    parse_mode: Any = None
+    disable_notification: bool | None = None
+    protect_content: bool | None = None
+    reply_to_message_id: str | None = None
+    allow_sending_without_reply: bool | None = None
+
+
+@dataclass(slots=True, kw_only=True)
+class PhotoTask(MediaTask):
+    photo: Any  # Local path, URL, file_id or bytes
+
+
+@dataclass(slots=True, kw_only=True)
+class DocumentTask(MediaTask):
+    document: Any
+
+
+@dataclass(slots=True, kw_only=True)
+class VideoTask(MediaTask):
+    video: Any
+
+
+@dataclass(slots=True, kw_only=True)
+class PollTask(MarkupTask):
+    question: str
+    options: list
+    type: str = "regular"
+    correct_option_id: int | None = None
+    is_anonymous: bool = False
+    open_period: int | None = None
+    allow_multiple_answers: bool | None = None
+    explanation: str | None = None
+    explanation_parse_mode: Any = None
+    reply_to_message_id: str | None = None
+    allow_sending_without_reply: bool | None = None
+
+
+@dataclass(slots=True, kw_only=True)
+class RunTask(Task):
+    data: dict  # Runs a state machine step with this data, it doesn't call the Telegram API
+    priority: str | None = field(default=RUN, repr=False)
+
+
+# Action names of the old add_task(user_id, action, params) API
+TASK_TYPES = {
+    "message": MessageTask,
+    "editmessage": EditMessageTask,
+    "delete": DeleteTask,
+    "photo": PhotoTask,
+    "document": DocumentTask,
+    "video": VideoTask,
+    "poll": PollTask,
+}
+
+
+def register(action, task_type):
+    '''
+    Makes a new task type available by name for add_task. The front-ends still need a handler for it in their dispatch table.
+    '''
+    TASK_TYPES[action] = task_type
+
+
+RUNTIME_FIELDS = ("done", "enqueued_at", "attempts", "queue_id")  # Only mean something in the running process
+
+
+def dump(task):
+    '''
+    Returns (type name, fields) of a task, to keep it somewhere and build it again with load.
+    '''
+    return type(task).__name__, {item.name: getattr(task, item.name) for item in fields(task) if item.name not in RUNTIME_FIELDS}
+
+
+def load(name, params):
+    types = {task_type.__name__: task_type for task_type in (*TASK_TYPES.values(), RunTask)}
+    task_type = types.get(name)
+    if task_type is None:
+        raise ValueError(f"Unknown task type: {name}")
+    return task_type(**params)
+
+
+def from_action(user_id, action, params, done=None):
+    if action == "run":
+        return RunTask(user_id=user_id, data=params, done=done)
+    task_type = TASK_TYPES.get(action)
+    if task_type is None:
+        raise ValueError(f"Unknown action: {action}")
+    return task_type(user_id=user_id, done=done, **params)
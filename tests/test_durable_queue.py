@@ -0,0 +1,140 @@
+'''
+SQLiteQueue keeps at most window tasks in memory and the rest on disk, these check that spilling and reading them back
+keeps the order of the tasks and their done futures, and what is replayed after a restart.
+'''
+import time
+import asyncio
+import sqlite3
+
+import tasks
+from durable_queue import SQLiteQueue
+
+
+def message(text, done=None):
+    return tasks.MessageTask(user_id=1, text=text, done=done)
+
+
+async def take(queue, count):
+    taken = []
+    for _ in range(count):
+        task = await asyncio.wait_for(queue.get(), 2)
+        taken.append(task)
+        queue.ack(task)
+    return taken
+
+
+def texts(taken):
+    return [task.text if isinstance(task, tasks.MessageTask) else task.caption for task in taken]
+
+
+def rows(path):
+    with sqlite3.connect(path) as connection:
+        return connection.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+
+def test_spills_past_the_window_and_reads_back_in_order(tmp_path):
+    async def run():
+        queue = SQLiteQueue(tmp_path / "tasks.db", window=4, flush_interval=0.01)
+        await queue.start()
+        for index in range(20):
+            await queue.put(message(str(index)))
+        assert len(queue.items) == 4 and queue.spilled == 16 and queue.qsize() == 20
+        taken = await take(queue, 20)
+        await asyncio.wait_for(queue.join(), 2)
+        await queue.stop()
+        return taken
+
+    assert texts(asyncio.run(run())) == [str(index) for index in range(20)]
+    assert rows(tmp_path / "tasks.db") == 0
+
+
+def test_spilled_tasks_keep_their_done_future_and_place(tmp_path):
+    async def run():
+        loop = asyncio.get_running_loop()
+        queue = SQLiteQueue(tmp_path / "tasks.db", window=4, flush_interval=0.01)
+        await queue.start()
+        futures = []
+        for index in range(10):
+            if index == 6:
+                await queue.put(tasks.PhotoTask(user_id=1, photo=b"not JSON", caption="photo"))
+            futures.append(loop.create_future())
+            await queue.put(message(str(index), futures[-1]))
+        taken = await take(queue, 11)
+        await queue.stop()
+        return taken, futures
+
+    taken, futures = asyncio.run(run())
+    assert texts(taken) == ["0", "1", "2", "3", "4", "5", "photo", "6", "7", "8", "9"]
+    assert [task.done for task in taken if isinstance(task, tasks.MessageTask)] == futures
+
+
+def test_restart_replays_before_new_tasks(tmp_path):
+    path = tmp_path / "tasks.db"
+
+    async def first():
+        queue = SQLiteQueue(path, window=4, flush_interval=0.01)
+        await queue.start()
+        for index in range(10):
+            await queue.put(message(f"old{index}"))
+        await take(queue, 2)
+        await queue.stop()  # The 8 left are replayed
+
+    async def second():
+        loop = asyncio.get_running_loop()
+        queue = SQLiteQueue(path, window=4, flush_interval=0.01)
+        await queue.put(message("a", loop.create_future()))
+        await queue.put(tasks.PhotoTask(user_id=1, photo=b"not JSON", caption="photo"))
+        await queue.put(message("b"))
+        await queue.start()
+        taken = await take(queue, 11)
+        await asyncio.wait_for(queue.join(), 2)
+        await queue.stop()
+        return taken
+
+    asyncio.run(first())
+    taken = asyncio.run(second())
+    assert texts(taken) == [f"old{index}" for index in range(2, 10)] + ["a", "photo", "b"]
+    assert taken[8].done is not None
+    assert rows(path) == 0
+
+
+def test_restart_with_the_clock_behind_the_stored_ids(tmp_path):
+    path = tmp_path / "tasks.db"
+
+    async def first():
+        queue = SQLiteQueue(path, window=4, flush_interval=0.01)
+        await queue.start()
+        queue.last_id = time.time_ns() + 10 ** 15  # Ids from a clock that was ahead by 11 days
+        for index in range(6):
+            await queue.put(message(f"old{index}"))
+        await queue.stop()
+
+    async def second():
+        queue = SQLiteQueue(path, window=4, flush_interval=0.01)
+        for index in range(6):
+            await queue.put(message(f"new{index}"))
+        await queue.start()
+        taken = await take(queue, 12)
+        await asyncio.wait_for(queue.join(), 2)
+        await queue.stop()
+        return taken
+
+    asyncio.run(first())
+    assert texts(asyncio.run(second())) == [f"old{index}" for index in range(6)] + [f"new{index}" for index in range(6)]
+
+
+def test_unwritten_tasks(tmp_path):
+    path = tmp_path / "tasks.db"
+
+    async def run():
+        queue = SQLiteQueue(path, window=100, flush_interval=3600)  # Only stop() flushes
+        await queue.start()
+        for index in range(5):
+            await queue.put(message(str(index)))
+        assert len(queue.unwritten) == 5
+        await take(queue, 2)  # Done before being written, they never reach the disk
+        assert len(queue.unwritten) == 3 and not queue.acked
+        await queue.stop()
+
+    asyncio.run(run())
+    assert rows(path) == 3
@@ -0,0 +1,186 @@
+'''
+Tasks that run later, without a sleeping asyncio task per timer:
+
+    timer_id = await sm.schedule(user_id, 3600, tasks.MessageTask(user_id=user_id, text="Reminder!"))
+    await sm.cancel_timer(timer_id)
+
+A hierarchical timer wheel: LEVELS wheels of SLOTS slots, each slot of a level covering a whole turn of the level below.
+A timer goes in the slot of the level that matches how far away it is, and moves down a level each time its slot comes
+up, so inserting and cancelling are O(1) and one tick only looks at the timers that are due. Ticks are TIMER_TICK_MS long,
+timers fire at most one tick late.
+
+If a storage backend is given, timers are also written to it in batches and loaded again on start, the ones that became
+due while the bot was down fire right away. A timer that fired just before a crash can fire again after the restart.
+'''
+import os
+import json
+import math
+import time
+import asyncio
+import itertools
+
+import tasks
+from storage import WriteBehind, FLUSH_INTERVAL
+
+TIMER_TICK = float(os.getenv("TIMER_TICK_MS", "100")) / 1000
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+LEVELS = 4  # 64^4 ticks, 19 days with 100 ms ticks. Later timers wait in the last level and go round again
+NAMESPACE = "timers"
+
+
+class Timer:
+    __slots__ = ("id", "expires", "at", "task", "slot")
+
+    def __init__(self, timer_id, expires, at, task):
+        self.id = timer_id
+        self.expires = expires  # Tick it fires on
+        self.at = at  # Wall clock time it fires at, what is persisted
+        self.task = task
+        self.slot = None  # Dict of the slot it is in
+
+
+class TimerWheel:
+    def __init__(self, backend=None, tick=TIMER_TICK, flush_interval=FLUSH_INTERVAL):
+        self.backend = backend
+        self.tick = tick
+        self.wheels = [[{} for _ in range(SLOTS)] for _ in range(LEVELS)]  # Slots are dicts of timer_id -> Timer
+        self.timers = {}  # timer_id -> Timer
+        self.ticks = 0  # Ticks elapsed since started
+        self.started = None  # loop.time() of tick 0
+        self.fire = None  # async function(task) that enqueues a due task, given to start()
+        self.writer = WriteBehind(backend, NAMESPACE, flush_interval)  # timer_id -> record to save, or None to delete
+        self.owns = None  # Optional function(user_id) -> bool, load() skips the timers of users it returns False for
+        self.ids = itertools.count()
+        self.armed = asyncio.Event()
+        self.runner = None
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, timer_id):
+        return timer_id in self.timers
+
+    def place(self, timer):
+        distance = max(0, timer.expires - self.ticks)
+        expires = timer.expires if distance < SLOTS ** LEVELS else self.ticks + SLOTS ** LEVELS - 1
+        level = 0
+        while distance >= SLOTS ** (level + 1) and level < LEVELS - 1:
+            level += 1
+        slot = self.wheels[level][(expires >> (SLOT_BITS * level)) & (SLOTS - 1)]
+        slot[timer.id] = timer
+        timer.slot = slot
+
+    def schedule(self, user_id, delay, task, timer_id=None):
+        '''
+        Enqueues task in delay seconds and returns the id of the timer. Scheduling again with the same timer_id replaces it.
+        '''
+        task.user_id = user_id
+        if timer_id is None:
+            timer_id = f"{time.time_ns()}-{next(self.ids)}"
+        self.cancel(timer_id)
+        # The current tick started up to a tick ago, one more so it never fires early
+        timer = Timer(timer_id, self.ticks + 1 + math.ceil(max(0.0, delay) / self.tick), time.time() + delay, task)
+        self.timers[timer_id] = timer
+        self.place(timer)
+        self.armed.set()
+        if self.backend:
+            record = {"at": timer.at, "task": tasks.dump(task)}
+            try:
+                json.dumps(record)
+            except (TypeError, ValueError):
+                record = None  # Not JSON, only in memory
+            self.writer.put(timer_id, record)
+        return timer_id
+
+    def cancel(self, timer_id):
+        '''
+        Returns True if the timer was pending.
+        '''
+        timer = self.timers.pop(timer_id, None)
+        if timer is None:
+            return False
+        del timer.slot[timer_id]
+        self.writer.put(timer_id, None)
+        return True
+
+    def advance(self):
+        '''
+        Moves the wheel one tick and returns the timers that are due.
+        '''
+        self.ticks += 1
+        for level in range(1, LEVELS):
+            # At the start of a turn of the level below, the timers of the next slot of this level move down
+            if self.ticks & ((1 << (SLOT_BITS * level)) - 1):
+                break
+            slot = self.wheels[level][(self.ticks >> (SLOT_BITS * level)) & (SLOTS - 1)]
+            timers = list(slot.values())
+            slot.clear()
+            for timer in timers:
+                self.place(timer)
+        slot = self.wheels[0][self.ticks & (SLOTS - 1)]
+        due = [timer for timer in slot.values() if timer.expires <= self.ticks]
+        for timer in due:
+            del slot[timer.id]
+            del self.timers[timer.id]
+            self.writer.put(timer.id, None)
+        return due
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.timers:
+                self.armed.clear()
+                await self.armed.wait()
+                # The wheel doesn't turn while it's empty, ticks start again from here
+                self.started = loop.time() - self.ticks * self.tick
+            await asyncio.sleep(self.started + (self.ticks + 1) * self.tick - loop.time())
+            while self.started + (self.ticks + 1) * self.tick <= loop.time():  # Catches up if the loop was busy
+                for timer in self.advance():
+                    try:
+                        await self.fire(timer.task)
+                    except Exception as e:
+                        print(f"Error firing timer {timer.id}: {e}")
+
+    async def load(self):
+        if not self.backend:
+            return
+        stored = await asyncio.to_thread(self.backend.load_values, NAMESPACE)
+        now = time.time()
+        for timer_id, record in stored.items():
+            try:
+                task = tasks.load(*record["task"])
+            except (TypeError, ValueError, KeyError) as e:
+                print(f"Dropping timer {timer_id} that can't be loaded: {e}")
+                continue
+            if self.owns is None or self.owns(task.user_id):
+                self.schedule(task.user_id, max(0.0, record["at"] - now), task, timer_id)
+                self.writer.discard(timer_id)  # It is already stored
+
+    def unload(self):
+        '''
+        Forgets the timers in memory, they stay stored for whoever loads them (the shards, when there are).
+        '''
+        for wheel in self.wheels:
+            for slot in wheel:
+                slot.clear()
+        self.timers.clear()
+
+    async def flush(self):
+        await self.writer.flush()
+
+    async def start(self, fire):
+        self.fire = fire
+        await self.load()
+        self.started = asyncio.get_running_loop().time() - self.ticks * self.tick
+        self.runner = asyncio.create_task(self.run())
+        if self.backend:
+            self.writer.start()
+
+    async def stop(self):
+        if self.runner:
+            self.runner.cancel()
+            await asyncio.gather(self.runner, return_exceptions=True)
+            self.runner = None
+        await self.writer.stop()
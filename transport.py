@@ -0,0 +1,65 @@
+'''
+What the engine needs from a Telegram library. There is one adapter per library (transport_hydrogram.py, transport_ptb.py),
+everything else (dispatcher, rate limits, markups, saved messages...) is shared and doesn't know which one is used.
+'''
+from typing import Any, AsyncIterator, Protocol
+
+
+class Transport(Protocol):
+    # reply_to_message_id and message_id are real Telegram message ids here, the engine already resolved the saved names.
+    # The send methods return the library's message object, message_id() gets its id.
+
+    async def send_message(self, chat_id, text, parse_mode=None, disable_web_page_preview=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None) -> Any: ...
+
+    async def edit_message_text(self, chat_id, message_id, text, parse_mode=None, disable_web_page_preview=None, reply_markup=None) -> Any: ...
+
+    async def delete_message(self, chat_id, message_id) -> Any: ...
+
+    async def send_photo(self, chat_id, photo, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None) -> Any: ...
+
+    async def send_document(self, chat_id, document, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None) -> Any: ...
+
+    async def send_video(self, chat_id, video, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None) -> Any: ...
+
+    async def send_poll(self, chat_id, question, options, type="regular", correct_option_id=None, is_anonymous=False, open_period=None, allow_multiple_answers=None, explanation=None, explanation_parse_mode=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None) -> Any: ...
+
+    def message_id(self, message) -> int: ...
+
+    def stream_file(self, file_id) -> AsyncIterator[bytes]:
+        '''
+        Downloads a file the bot received, yielding it in chunks.
+        '''
+
+    def file_id(self, message, kind) -> str | None:
+        '''
+        file_id of the media of a sent message, kind is "photo", "document" or "video". Used to send it again without uploading it.
+        '''
+
+    # Markups, rows of captions for keyboard and rows of (caption, callback_data) for inline_keyboard
+    def keyboard(self, rows) -> Any: ...
+
+    def inline_keyboard(self, rows) -> Any: ...
+
+    def remove_keyboard(self) -> Any: ...
+
+    # Errors
+    def retry_after(self, error) -> float | None:
+        '''
+        Seconds Telegram asked to wait if the error is a flood wait, else None.
+        '''
+
+    def is_api_error(self, error) -> bool:
+        '''
+        True if the error is one of the library's Telegram errors. Edits and deletes that fail with one are only logged.
+        '''
+
+    def is_invalid_file(self, error) -> bool:
+        '''
+        True if Telegram rejected a file_id, the media cache then uploads the file again.
+        '''
+
+    def classify(self, error) -> str:
+        '''
+        What the dispatcher does with a task that failed with this error (flood waits aside): retry.RETRY for network
+        errors and Telegram's internal errors, retry.BLOCKED if the user blocked the bot or is gone, else retry.PERMANENT.
+        '''
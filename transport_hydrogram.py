@@ -0,0 +1,139 @@
+from hydrogram.types import (
+    ReplyKeyboardMarkup,
+    KeyboardButton,
+    ReplyKeyboardRemove,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton
+)
+from hydrogram.errors import RPCError, FloodWait, BadRequest, Forbidden, InternalServerError, ServiceUnavailable
+
+import retry
+
+GONE = {"USER_IS_BLOCKED", "USER_DEACTIVATED", "USER_DEACTIVATED_BAN", "INPUT_USER_DEACTIVATED", "PEER_ID_INVALID", "CHAT_WRITE_FORBIDDEN"}
+
+
+class HydrogramTransport:
+    '''
+    Transport for a hydrogram Client. Create the client with sleep_threshold=0 so flood waits reach the dispatcher.
+    '''
+    def __init__(self, client):
+        self.client = client
+
+    # allow_sending_without_reply doesn't exist in hydrogram, it is accepted and ignored
+
+    async def send_message(self, chat_id, text, parse_mode=None, disable_web_page_preview=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None):
+        return await self.client.send_message(
+            chat_id=chat_id,
+            text=text,
+            parse_mode=parse_mode,
+            disable_web_page_preview=disable_web_page_preview,
+            disable_notification=disable_notification,
+            protect_content=protect_content,
+            reply_to_message_id=reply_to_message_id,
+            reply_markup=reply_markup
+        )
+
+    async def edit_message_text(self, chat_id, message_id, text, parse_mode=None, disable_web_page_preview=None, reply_markup=None):
+        return await self.client.edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=text,
+            parse_mode=parse_mode,
+            disable_web_page_preview=disable_web_page_preview,
+            reply_markup=reply_markup
+        )
+
+    async def delete_message(self, chat_id, message_id):
+        # hydrogram usa delete_messages (plural) y message_ids
+        return await self.client.delete_messages(chat_id=chat_id, message_ids=message_id)
+
+    async def send_photo(self, chat_id, photo, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None):
+        return await self.client.send_photo(
+            chat_id=chat_id,
+            photo=photo,
+            caption=caption,
+            parse_mode=parse_mode,
+            disable_notification=disable_notification,
+            protect_content=protect_content,
+            reply_to_message_id=reply_to_message_id,
+            reply_markup=reply_markup
+        )
+
+    async def send_document(self, chat_id, document, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None):
+        return await self.client.send_document(
+            chat_id=chat_id,
+            document=document,
+            caption=caption,
+            parse_mode=parse_mode,
+            disable_notification=disable_notification,
+            protect_content=protect_content,
+            reply_to_message_id=reply_to_message_id,
+            reply_markup=reply_markup
+        )
+
+    async def send_video(self, chat_id, video, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None):
+        return await self.client.send_video(
+            chat_id=chat_id,
+            video=video,
+            caption=caption,
+            parse_mode=parse_mode,
+            disable_notification=disable_notification,
+            protect_content=protect_content,
+            reply_to_message_id=reply_to_message_id,
+            reply_markup=reply_markup
+        )
+
+    async def send_poll(self, chat_id, question, options, type="regular", correct_option_id=None, is_anonymous=False, open_period=None, allow_multiple_answers=None, explanation=None, explanation_parse_mode=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None):
+        return await self.client.send_poll(
+            chat_id=chat_id,
+            question=question,
+            options=options,
+            type=type, # enums.PollType.REGULAR or enums.PollType.QUIZ en hydrogram
+            correct_option_id=correct_option_id,
+            is_anonymous=is_anonymous,
+            open_period=open_period,
+            allows_multiple_answers=allow_multiple_answers, # Nota: En hydrogram es 'allows_' con 's'
+            explanation=explanation,
+            explanation_parse_mode=explanation_parse_mode,
+            reply_to_message_id=reply_to_message_id,
+            reply_markup=reply_markup
+        )
+
+    def message_id(self, message):
+        return message.id # hydrogram usa .id
+
+    async def stream_file(self, file_id):
+        async for chunk in self.client.stream_media(file_id): # Partes de 1 MB
+            yield chunk
+
+    def file_id(self, message, kind):
+        media = getattr(message, kind, None)
+        return media.file_id if media else None
+
+    def keyboard(self, rows):
+        return ReplyKeyboardMarkup([[KeyboardButton(text=caption) for caption in row] for row in rows], resize_keyboard=True)
+
+    def inline_keyboard(self, rows):
+        return InlineKeyboardMarkup([[InlineKeyboardButton(text=caption, callback_data=data) for caption, data in row] for row in rows])
+
+    def remove_keyboard(self):
+        return ReplyKeyboardRemove()
+
+    def retry_after(self, error):
+        if isinstance(error, FloodWait):
+            return error.value
+        return None
+
+    def is_api_error(self, error):
+        return isinstance(error, RPCError)
+
+    def is_invalid_file(self, error):
+        # FILE_ID_INVALID, FILE_REFERENCE_EXPIRED, MEDIA_EMPTY...
+        return isinstance(error, BadRequest) and ("FILE" in (error.ID or "") or error.ID == "MEDIA_EMPTY")
+
+    def classify(self, error):
+        if isinstance(error, Forbidden) or (isinstance(error, RPCError) and error.ID in GONE):
+            return retry.BLOCKED
+        if isinstance(error, (InternalServerError, ServiceUnavailable, *retry.transient_errors)):
+            return retry.RETRY
+        return retry.PERMANENT
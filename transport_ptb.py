@@ -0,0 +1,153 @@
+import asyncio
+import aiohttp
+import telegram
+import retry
+from telegram import ReplyKeyboardMarkup, KeyboardButton
+
+
+class PTBTransport:
+    '''
+    Transport for a python-telegram-bot Bot (application.bot).
+    '''
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def send_message(self, chat_id, text, parse_mode=None, disable_web_page_preview=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None):
+        return await self.bot.send_message(
+            chat_id=chat_id,
+            text=text,
+            parse_mode=parse_mode,
+            # entities=entities,
+            disable_web_page_preview=disable_web_page_preview,
+            disable_notification=disable_notification,
+            protect_content=protect_content,
+            reply_to_message_id=reply_to_message_id,
+            allow_sending_without_reply=allow_sending_without_reply,
+            reply_markup=reply_markup
+            # message_thread_id=message_thread_id
+        )
+
+    async def edit_message_text(self, chat_id, message_id, text, parse_mode=None, disable_web_page_preview=None, reply_markup=None):
+        return await self.bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=text,
+            parse_mode=parse_mode,
+            # entities=entities,
+            disable_web_page_preview=disable_web_page_preview,
+            reply_markup=reply_markup
+        )
+
+    async def delete_message(self, chat_id, message_id):
+        return await self.bot.delete_message(chat_id=chat_id, message_id=message_id)
+
+    # photo, document and video may be a local file path, a URL, a file ID of an existing Telegram file or a bytes object with the data
+
+    async def send_photo(self, chat_id, photo, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None):
+        return await self.bot.send_photo(
+            chat_id=chat_id,
+            photo=photo,
+            caption=caption,
+            parse_mode=parse_mode,
+            disable_notification=disable_notification,
+            protect_content=protect_content,
+            reply_to_message_id=reply_to_message_id,
+            allow_sending_without_reply=allow_sending_without_reply,
+            reply_markup=reply_markup
+        )
+
+    async def send_document(self, chat_id, document, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None):
+        return await self.bot.send_document(
+            chat_id=chat_id,
+            document=document,
+            caption=caption,
+            parse_mode=parse_mode,
+            disable_notification=disable_notification,
+            protect_content=protect_content,
+            reply_to_message_id=reply_to_message_id,
+            allow_sending_without_reply=allow_sending_without_reply,
+            reply_markup=reply_markup
+        )
+
+    async def send_video(self, chat_id, video, caption=None, parse_mode=None, disable_notification=None, protect_content=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None):
+        return await self.bot.send_video(
+            chat_id=chat_id,
+            video=video,
+            caption=caption,
+            parse_mode=parse_mode,
+            disable_notification=disable_notification,
+            protect_content=protect_content,
+            reply_to_message_id=reply_to_message_id,
+            allow_sending_without_reply=allow_sending_without_reply,
+            reply_markup=reply_markup
+        )
+
+    async def send_poll(self, chat_id, question, options, type="regular", correct_option_id=None, is_anonymous=False, open_period=None, allow_multiple_answers=None, explanation=None, explanation_parse_mode=None, reply_to_message_id=None, allow_sending_without_reply=None, reply_markup=None):
+        return await self.bot.send_poll(
+            chat_id=chat_id,
+            question=question,
+            options=options,
+            type=type, # "regular" or "quiz"
+            correct_option_id=correct_option_id,
+            is_anonymous=is_anonymous,
+            open_period=open_period,
+            allow_multiple_answers=allow_multiple_answers,
+            explanation=explanation,
+            explanation_parse_mode=explanation_parse_mode,
+            reply_to_message_id=reply_to_message_id,
+            allow_sending_without_reply=allow_sending_without_reply,
+            reply_markup=reply_markup
+        )
+
+    def message_id(self, message):
+        return message.message_id
+
+    async def stream_file(self, file_id, chunk_size=1024 * 1024):
+        file = await self.bot.get_file(file_id)
+        if not file.file_path.startswith(("http://", "https://")):  # Local Bot API server, the file is already on this machine
+            with open(file.file_path, "rb") as source:
+                while chunk := await asyncio.to_thread(source.read, chunk_size):
+                    yield chunk
+            return
+        # File.download_* reads the whole file into memory, this streams it
+        async with aiohttp.ClientSession() as session, session.get(file.file_path) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+
+    def file_id(self, message, kind):
+        media = getattr(message, kind, None)
+        if isinstance(media, (list, tuple)):  # Photos come in every size, the last one is the largest
+            media = media[-1] if media else None
+        return media.file_id if media else None
+
+    def keyboard(self, rows):
+        return ReplyKeyboardMarkup([[KeyboardButton(text=caption) for caption in row] for row in rows], resize_keyboard=True)
+
+    def inline_keyboard(self, rows):
+        return telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(text=caption, callback_data=data) for caption, data in row] for row in rows])
+
+    def remove_keyboard(self):
+        return telegram.ReplyKeyboardRemove()
+
+    def retry_after(self, error):
+        if isinstance(error, telegram.error.RetryAfter):
+            seconds = error.retry_after
+            return seconds.total_seconds() if hasattr(seconds, "total_seconds") else seconds  # Newer versions use a timedelta
+        return None
+
+    def is_api_error(self, error):
+        return isinstance(error, telegram.error.TelegramError)
+
+    def is_invalid_file(self, error):
+        # "Wrong file identifier/http url specified", "Wrong remote file identifier specified..."
+        return isinstance(error, telegram.error.BadRequest) and "file identifier" in error.message.lower()
+
+    def classify(self, error):
+        if isinstance(error, telegram.error.Forbidden):  # "Forbidden: bot was blocked by the user", "...user is deactivated"
+            return retry.BLOCKED
+        if isinstance(error, telegram.error.BadRequest):
+            return retry.BLOCKED if "chat not found" in error.message.lower() else retry.PERMANENT
+        if isinstance(error, (telegram.error.NetworkError, *retry.transient_errors)):  # TimedOut is a NetworkError
+            return retry.RETRY
+        return retry.PERMANENT
@@ -0,0 +1,91 @@
+'''
+Small aiohttp server that receives Telegram updates by webhook instead of long polling.
+It checks the secret token header, hands the update to a callback that only enqueues it and answers 200 right away.
+WEBHOOK_SECRET is required, without it anyone who reaches the server could send updates as any user.
+
+Recorded updates (one JSON update per line) can be POSTed to a local server to try it offline:
+    python webhook.py recorded_updates.jsonl --url http://localhost:8080/webhook --secret my-secret
+'''
+import os
+import hmac
+import json
+import asyncio
+import argparse
+
+from aiohttp import web, ClientSession
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public URL Telegram sends the updates to. If it's not set the bot uses polling
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Also given to Telegram, which sends it back in SECRET_HEADER
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def create_app(on_update, secret_token=WEBHOOK_SECRET, path=WEBHOOK_PATH):
+    '''
+    Returns an aiohttp application that calls on_update(payload) for every valid update. on_update must not block.
+    '''
+    if not secret_token:
+        raise ValueError("Webhook mode needs WEBHOOK_SECRET in the .env")
+    secret = secret_token.encode()
+
+    async def handle_update(request):
+        # Compared as bytes, compare_digest raises TypeError for strings that are not ASCII
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, "").encode(), secret):
+            return web.Response(status=401)
+        try:
+            payload = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            on_update(payload)
+        except Exception as e:
+            # Answering with an error would make Telegram send the same update again and again
+            print(f"Error enqueuing webhook update: {e}")
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    return app
+
+
+async def start_server(on_update, host=WEBHOOK_HOST, port=WEBHOOK_PORT, secret_token=WEBHOOK_SECRET, path=WEBHOOK_PATH):
+    '''
+    Starts the server in the running loop and returns its runner. Call runner.cleanup() to stop it.
+    '''
+    runner = web.AppRunner(create_app(on_update, secret_token, path))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def replay_updates(url, updates, secret_token=None):
+    '''
+    POSTs recorded updates to a running webhook server, in order. Returns the list of status codes.
+    '''
+    headers = {SECRET_HEADER: secret_token} if secret_token else {}
+    statuses = []
+    async with ClientSession() as session:
+        for update in updates:
+            async with session.post(url, json=update, headers=headers) as response:
+                statuses.append(response.status)
+    return statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="File with one JSON update per line")
+    parser.add_argument("--url", default=f"http://localhost:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    parser.add_argument("--secret", default=WEBHOOK_SECRET)
+    args = parser.parse_args()
+
+    with open(args.file) as file:
+        updates = [json.loads(line) for line in file if line.strip()]
+    statuses = asyncio.run(replay_updates(args.url, updates, args.secret))
+    print(f"Sent {len(statuses)} updates, {statuses.count(200)} accepted")
+
+
+if __name__ == "__main__":
+    main()